@@ -0,0 +1,39 @@
+import sys
+import time
+from chunking import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, chunk_pages, count_tokens, get_encoding
+from pdf_extract import iter_pdf_pages
+
+# -----------------------------
+# CONFIGURATION
+# -----------------------------
+# Usage: python bench_chunking.py <pdf_path> [max_tokens] [overlap_tokens] [runs]
+PDF_FILE_PATH = sys.argv[1] if len(sys.argv) > 1 else "content/tricare-provider-handbook.pdf"
+MAX_TOKENS = int(sys.argv[2]) if len(sys.argv) > 2 else CHUNK_MAX_TOKENS
+OVERLAP_TOKENS = int(sys.argv[3]) if len(sys.argv) > 3 else CHUNK_OVERLAP_TOKENS
+NUM_RUNS = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+
+if __name__ == "__main__":
+    pages = list(iter_pdf_pages(PDF_FILE_PATH))
+    total_chars = sum(len(text) for _, text in pages)
+    encoding = get_encoding()
+    print(f"Chunking {PDF_FILE_PATH}: {len(pages)} pages, {total_chars} characters")
+    print(f"Encoding: {encoding.name} | max_tokens={MAX_TOKENS} | overlap_tokens={OVERLAP_TOKENS}\n")
+
+    timings = []
+    chunks = []
+    for _ in range(NUM_RUNS):
+        start = time.perf_counter()
+        chunks = list(chunk_pages(pages, MAX_TOKENS, OVERLAP_TOKENS))
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    token_counts = [count_tokens(chunk.text) for chunk in chunks]
+    print(f"Chunks:  {len(chunks)}")
+    print(f"Tokens per chunk: min {min(token_counts, default=0)} | max {max(token_counts, default=0)} "
+          f"| avg {sum(token_counts) / max(len(token_counts), 1):.0f}")
+    print(f"Best:    {timings[0]:.2f} ms")
+    print(f"Median:  {timings[len(timings) // 2]:.2f} ms")
+    print(f"Throughput: {total_chars / timings[0] / 1000:.1f} M characters/s")
+    if max(token_counts, default=0) > MAX_TOKENS:
+        print("\nERROR: a chunk exceeds max_tokens")
+        sys.exit(1)
@@ -0,0 +1,36 @@
+import sys
+import time
+import os
+from pdf_extract import iter_pdf_pages, iter_pdf_pages_parallel
+
+# -----------------------------
+# CONFIGURATION
+# -----------------------------
+# Usage: python bench_extract.py <pdf_path> [workers] [pages_per_task] [runs]
+PDF_FILE_PATH = sys.argv[1] if len(sys.argv) > 1 else "content/tricare-provider-handbook.pdf"
+WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 2)
+PAGES_PER_TASK = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+NUM_RUNS = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+
+def run(name, extract):
+    timings = []
+    pages = None
+    for _ in range(NUM_RUNS):
+        start = time.perf_counter()
+        pages = list(extract())
+        timings.append((time.perf_counter() - start) * 1000)
+    best = min(timings)
+    print(f"{name}: best {best:.1f} ms over {NUM_RUNS} runs | {len(pages)} pages | {len(pages) / best * 1000:.0f} pages/s")
+    return pages, best
+
+if __name__ == "__main__":
+    print(f"Benchmarking text extraction of {PDF_FILE_PATH}\n")
+    serial_pages, serial_ms = run("Serial", lambda: iter_pdf_pages(PDF_FILE_PATH))
+    parallel_pages, parallel_ms = run(
+        f"Parallel ({WORKERS} processes, {PAGES_PER_TASK} pages/task)",
+        lambda: iter_pdf_pages_parallel(PDF_FILE_PATH, WORKERS, PAGES_PER_TASK)
+    )
+    if parallel_pages != serial_pages:
+        print("\nERROR: parallel extraction output differs from serial extraction")
+        sys.exit(1)
+    print(f"\nOutput identical, speedup: {serial_ms / parallel_ms:.2f}x")
@@ -0,0 +1,66 @@
+import sys
+import json
+import time
+import random
+import hashlib
+from flask import Flask, Response, jsonify, request
+
+# -----------------------------
+# CONFIGURATION
+# -----------------------------
+# Local stand-in for Azure AI Search, the Azure OpenAI embeddings endpoint and
+# query_service.py, so timing.py can be exercised without cloud resources.
+# Usage: python bench_server.py [port] [latency_ms] [jitter_ms] [dimensions]
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8900
+LATENCY_MS = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+JITTER_MS = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+DIMENSIONS = int(sys.argv[4]) if len(sys.argv) > 4 else 3072
+
+app = Flask(__name__)
+
+# Sleeps for a simulated service time and returns it in milliseconds
+def simulate_work(scale=1.0):
+    service_ms = max(0.0, random.gauss(LATENCY_MS, JITTER_MS)) * scale
+    time.sleep(service_ms / 1000)
+    return service_ms
+
+def fake_embedding(text, dimensions):
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    return [rng.uniform(-1, 1) for _ in range(dimensions)]
+
+@app.route('/indexes/<index>/docs/search', methods=['POST'])
+def search(index):
+    body = request.get_json(silent=True) or {}
+    service_ms = simulate_work()
+    values = [{"@search.score": 1.0 / (i + 1), "document_num": "bench", "page_num": str(i), "chunk": f"Result {i}"}
+              for i in range(body.get("top", 5))]
+    response = jsonify({"value": values})
+    response.headers["elapsed-time"] = str(int(service_ms))
+    return response
+
+@app.route('/openai/deployments/<deployment>/embeddings', methods=['POST'])
+def embeddings(deployment):
+    body = request.get_json(silent=True) or {}
+    inputs = body.get("input", "")
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    simulate_work()
+    return jsonify({"data": [{"index": i, "embedding": fake_embedding(text, body.get("dimensions", DIMENSIONS))} for i, text in enumerate(inputs)]})
+
+# End-to-end question: embedding, search and a chat completion take about 5x a single call
+@app.route('/ask', methods=['POST'])
+def ask():
+    body = request.get_json(silent=True) or {}
+    if body.get("stream"):
+        def events():
+            simulate_work(2.0)
+            for word in "This is a simulated answer.".split():
+                simulate_work(0.5)
+                yield f"data: {json.dumps({'delta': word + ' '})}\n\n"
+            yield f"data: {json.dumps({'done': True, 'cached': False, 'sources': []})}\n\n"
+        return Response(events(), mimetype="text/event-stream")
+    simulate_work(5.0)
+    return jsonify({"answer": "This is a simulated answer.", "cached": False, "sources": []})
+
+if __name__ == '__main__':
+    print(f"Benchmark stand-in server listening on 127.0.0.1:{PORT} ({LATENCY_MS:g} ms +/- {JITTER_MS:g} ms per call)")
+    app.run(host="127.0.0.1", port=PORT, threaded=True)
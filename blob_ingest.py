@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from dotenv import load_dotenv
+from clients import get_container_client, get_search_client
+from decoders import UnsupportedFormatError
+from indexing import delete_chunks, document_id, get_existing_chunk_ids
+from ingest import SEARCH_API_KEY, SEARCH_INDEX_NAME, SEARCH_SERVICE_ENDPOINT, ingest_file
+from telemetry import start_metrics_server
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# ETag and last-modified time of every ingested blob, and where blobs are downloaded to
+BLOB_INGEST_STATE = os.getenv("BLOB_INGEST_STATE", ".cache/blob_ingest.json")
+BLOB_INGEST_DIR = os.getenv("BLOB_INGEST_DIR", ".cache/blobs")
+# Only blobs whose name starts with this prefix are ingested
+BLOB_INGEST_PREFIX = os.getenv("BLOB_INGEST_PREFIX") or None
+BLOB_INGEST_POLL_SECONDS = float(os.getenv("BLOB_INGEST_POLL_SECONDS", "60"))
+# Blobs downloaded and ingested at the same time, and ranged reads per download
+BLOB_INGEST_CONCURRENCY = int(os.getenv("BLOB_INGEST_CONCURRENCY", "4"))
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "4"))
+
+def _blob_version(blob):
+    return {"etag": blob.etag, "last_modified": blob.last_modified.isoformat() if blob.last_modified else None}
+
+# Polls a blob container and ingests blobs that are new or whose ETag or last-modified
+# time changed since the last pass. Chunk ids are derived from "<container>/<blob name>",
+# so a changed blob only re-embeds the chunks that changed, and the chunks of a deleted
+# blob are removed from the index.
+class BlobIngestWorker:
+    def __init__(self, container_client=None, prefix=BLOB_INGEST_PREFIX, state_path=BLOB_INGEST_STATE,
+                 directory=BLOB_INGEST_DIR, concurrency=BLOB_INGEST_CONCURRENCY):
+        self.container_client = container_client or get_container_client()
+        self.prefix = prefix
+        self.state_path = state_path
+        self.directory = directory
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self.state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"blobs": {}}
+
+    def _save_state(self):
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.state_path)
+
+    def source_for(self, name):
+        return f"{self.container_client.container_name}/{name}"
+
+    def local_path(self, name):
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(os.path.normpath(self.directory) + os.sep):
+            raise ValueError(f"Refusing to write {name} outside {self.directory}")
+        return path
+
+    # Function to download a blob to disk. Large blobs are read as concurrent ranged
+    # requests; the ETag condition makes the download fail instead of mixing ranges of
+    # two versions when the blob is overwritten meanwhile.
+    def download(self, blob):
+        path = self.local_path(blob.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".part"
+        downloader = self.container_client.download_blob(
+            blob.name, max_concurrency=BLOB_DOWNLOAD_CONCURRENCY,
+            etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+        with open(temp_path, "wb") as f:
+            downloader.readinto(f)
+        os.replace(temp_path, path)
+        return path
+
+    def ingest_blob(self, blob):
+        path = self.download(blob)
+        metadata = blob.metadata or {}
+        url = unquote(metadata["source_url"]) if metadata.get("source_url") else None
+        content_type = (blob.content_settings.content_type or "") if blob.content_settings else ""
+        try:
+            stats = ingest_file(path, self.source_for(blob.name), incremental=True, url=url, content_type=content_type)
+        finally:
+            os.remove(path)
+        if stats.failed:
+            raise RuntimeError(f"{len(stats.failed)} chunks failed to upload")
+        return stats
+
+    def remove_blob(self, search_client, name):
+        document_num = document_id(self.source_for(name))
+        stale_ids = get_existing_chunk_ids(search_client, document_num)
+        if stale_ids:
+            delete_chunks(search_client, stale_ids)
+        logger.info(f"Removed {len(stale_ids)} chunks of deleted blob {name}")
+
+    # Function to run one pass over the container. Returns a summary of the pass.
+    def run_once(self):
+        known = self.state["blobs"]
+        listed = {}
+        changed = []
+        for blob in self.container_client.list_blobs(name_starts_with=self.prefix, include=["metadata"]):
+            version = _blob_version(blob)
+            listed[blob.name] = version
+            if known.get(blob.name) != version:
+                changed.append(blob)
+        deleted = [name for name in known if name not in listed and name.startswith(self.prefix or "")]
+
+        summary = {"listed": len(listed), "ingested": 0, "unchanged": len(listed) - len(changed),
+                   "skipped": 0, "deleted": 0, "failed": [], "chunks_uploaded": 0}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.ingest_blob, blob): blob for blob in changed}
+            for future in as_completed(futures):
+                blob = futures[future]
+                try:
+                    stats = future.result()
+                except UnsupportedFormatError as e:
+                    # Recorded so the blob is not downloaded again until it changes
+                    logger.warning(f"Skipped {blob.name}: {e}")
+                    with self._lock:
+                        known[blob.name] = listed[blob.name]
+                    summary["skipped"] += 1
+                    continue
+                except (ResourceModifiedError, ResourceNotFoundError):
+                    # Overwritten or deleted since it was listed; the next pass sees the new state
+                    logger.info(f"Blob {blob.name} changed during download, retrying on the next pass")
+                    continue
+                except Exception as e:
+                    logger.error(f"Failed to ingest {blob.name}: {e}")
+                    summary["failed"].append(blob.name)
+                    continue
+                with self._lock:
+                    known[blob.name] = listed[blob.name]
+                summary["ingested"] += 1
+                summary["chunks_uploaded"] += stats.succeeded
+
+        if deleted:
+            search_client = get_search_client(SEARCH_INDEX_NAME, SEARCH_SERVICE_ENDPOINT, SEARCH_API_KEY)
+            for name in deleted:
+                try:
+                    self.remove_blob(search_client, name)
+                except Exception as e:
+                    logger.error(f"Failed to remove chunks of {name}: {e}")
+                    summary["failed"].append(name)
+                    continue
+                del known[name]
+                summary["deleted"] += 1
+        self._save_state()
+        elapsed = time.perf_counter() - start
+        logger.info(f"Blob ingest pass: {summary['listed']} blobs, {summary['ingested']} ingested, "
+                    f"{summary['unchanged']} unchanged, {summary['skipped']} skipped, {summary['deleted']} deleted, {len(summary['failed'])} failed, "
+                    f"{summary['chunks_uploaded']} chunks uploaded in {elapsed:.1f}s")
+        return summary
+
+    # Function to poll the container until interrupted
+    def run_forever(self, poll_seconds=BLOB_INGEST_POLL_SECONDS):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Blob ingest pass failed: {e}")
+            time.sleep(poll_seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest new and changed blobs of AZURE_STORAGE_CONTAINER into the search index")
+    parser.add_argument("--once", action="store_true", help="run a single pass instead of polling")
+    parser.add_argument("--prefix", default=BLOB_INGEST_PREFIX, help="only ingest blobs whose name starts with this")
+    parser.add_argument("--poll-seconds", type=float, default=BLOB_INGEST_POLL_SECONDS)
+    parser.add_argument("--concurrency", type=int, default=BLOB_INGEST_CONCURRENCY)
+    args = parser.parse_args()
+
+    start_metrics_server()
+    worker = BlobIngestWorker(prefix=args.prefix, concurrency=args.concurrency)
+    if args.once:
+        summary = worker.run_once()
+        if summary["failed"]:
+            raise SystemExit(1)
+    else:
+        worker.run_forever(args.poll_seconds)
+
+if __name__ == "__main__":
+    main()
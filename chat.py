@@ -1,4 +1,5 @@
 import os
+import time
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 
@@ -12,6 +13,7 @@ aisearch_endpoint = os.getenv("AZURE_AISEARCH_ENDPOINT", "")
 aisearch_key = os.getenv("AZURE_AISEARCH_KEY", "")
 aisearch_index = os.getenv("AZURE_AISEARCH_INDEX", "")
 subscription_key = os.getenv("AZURE_SUBSCRIPTION", "")
+stream = os.getenv("CHAT_STREAM", "true").lower() == "true"
 
 print(azure_openai_endpoint)
 print(azure_openai_key)
@@ -31,6 +33,7 @@ client = AzureOpenAI(
     api_version = "2024-05-01-preview",
 )
 
+start = time.perf_counter()
 completion = client.chat.completions.create(
     model=model_chat_deployment,
     messages= [
@@ -49,7 +52,7 @@ completion = client.chat.completions.create(
     frequency_penalty=0,
     presence_penalty=0,
     stop=None,
-    stream=False,
+    stream=stream,
     extra_body={
       "data_sources": [{
           "type": "azure_search",
@@ -79,4 +82,16 @@ completion = client.chat.completions.create(
         }]
     })
 
-print(completion.to_json())
\ No newline at end of file
+if stream:
+    # Print the answer as it arrives and measure time to first token separately from total latency
+    first_token_ms = None
+    for chunk in completion:
+        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - start) * 1000
+            print(chunk.choices[0].delta.content, end="", flush=True)
+    print()
+    total_ms = (time.perf_counter() - start) * 1000
+    print(f"Time to first token: {first_token_ms or 0:.0f} ms | Total: {total_ms:.0f} ms")
+else:
+    print(completion.to_json())
\ No newline at end of file
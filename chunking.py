@@ -0,0 +1,166 @@
+import os
+import re
+import logging
+import threading
+from typing import NamedTuple
+from dotenv import load_dotenv
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# cl100k_base is the encoding used by text-embedding-ada-002 and text-embedding-3-*
+CHUNK_ENCODING = os.getenv("CHUNK_ENCODING", "cl100k_base")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "7000"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "200"))
+# Sentence-packed chunks are sized for retrieval: several fit in the chat context budget
+SENTENCE_CHUNK_MAX_TOKENS = int(os.getenv("SENTENCE_CHUNK_MAX_TOKENS", "400"))
+SENTENCE_CHUNK_OVERLAP_TOKENS = int(os.getenv("SENTENCE_CHUNK_OVERLAP_TOKENS", "50"))
+
+# A chunk of a page. start and end are character offsets into the page text.
+class Chunk(NamedTuple):
+    text: str
+    page_num: int
+    start: int
+    end: int
+
+# Approximates BPE tokens when tiktoken or its encoding file is unavailable:
+# words, numbers and punctuation runs each count as one token
+_FALLBACK_TOKEN = re.compile(r"\s*(?:\w+|[^\w\s]+)", re.UNICODE)
+
+class _RegexEncoding:
+    name = "regex-approximation"
+
+    def encode(self, text):
+        return _FALLBACK_TOKEN.findall(text)
+
+    def token_offsets(self, text):
+        return [match.start() for match in _FALLBACK_TOKEN.finditer(text)]
+
+class _TiktokenEncoding:
+    def __init__(self, encoding):
+        self._encoding = encoding
+        self.name = encoding.name
+
+    def encode(self, text):
+        return self._encoding.encode(text, disallowed_special=())
+
+    def token_offsets(self, text):
+        return self._encoding.decode_with_offsets(self.encode(text))[1]
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                if tiktoken is None:
+                    raise ImportError("tiktoken is not installed")
+                _encoding = _TiktokenEncoding(tiktoken.get_encoding(CHUNK_ENCODING))
+            except Exception as e:
+                logger.warning(f"Falling back to approximate token counts, could not load {CHUNK_ENCODING}: {e}")
+                _encoding = _RegexEncoding()
+        return _encoding
+
+def count_tokens(text):
+    return len(get_encoding().encode(text))
+
+# Function to split text into chunks of at most max_tokens tokens, consecutive
+# chunks sharing overlap_tokens tokens. Chunks keep their character offsets.
+def chunk_text(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, page_num=0):
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens")
+    # Fast path: a token covers at least one UTF-8 byte, so text this short fits in one chunk
+    if len(text) <= max_tokens and len(text.encode("utf-8")) <= max_tokens:
+        offsets = None
+    else:
+        offsets = get_encoding().token_offsets(text)
+    if offsets is None or len(offsets) <= max_tokens:
+        chunk = _make_chunk(text, page_num, 0, len(text))
+        return [chunk] if chunk else []
+
+    chunks = []
+    first = 0
+    while first < len(offsets):
+        last = min(first + max_tokens, len(offsets))
+        end = offsets[last] if last < len(offsets) else len(text)
+        chunk = _make_chunk(text, page_num, offsets[first], end)
+        if chunk:
+            chunks.append(chunk)
+        if last == len(offsets):
+            break
+        first = last - overlap_tokens
+    return chunks
+
+# Sentence boundary: whitespace after ".", "?" or "!", except after abbreviations
+# such as "e.g." and "Dr."
+_SENTENCE_END = re.compile(r"(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=[.?!])\s+")
+
+# (start, end) character offsets of the sentences of text, whitespace between them excluded
+def sentence_spans(text):
+    spans = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        spans.append((start, match.start()))
+        start = match.end()
+    spans.append((start, len(text)))
+    return [(start, end) for start, end in spans if text[start:end].strip()]
+
+# Function to pack consecutive sentences into chunks of at most max_tokens tokens.
+# Each new chunk repeats the trailing sentences of the previous one, up to
+# overlap_tokens, and a sentence longer than max_tokens is split with chunk_text.
+def chunk_sentences(text, max_tokens=SENTENCE_CHUNK_MAX_TOKENS, overlap_tokens=SENTENCE_CHUNK_OVERLAP_TOKENS, page_num=0):
+    if overlap_tokens >= max_tokens:
+        raise ValueError("overlap_tokens must be smaller than max_tokens")
+    units = []  # (start, end, tokens)
+    for start, end in sentence_spans(text):
+        sentence = text[start:end]
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            units.append((start, end, tokens))
+            continue
+        for piece in chunk_text(sentence, max_tokens, overlap_tokens):
+            units.append((start + piece.start, start + piece.end, count_tokens(piece.text)))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for unit in units:
+        if current and current_tokens + unit[2] > max_tokens:
+            chunks.append(_make_chunk(text, page_num, current[0][0], current[-1][1]))
+            # Carry the trailing sentences that fit in the overlap and leave room for this one
+            overlap = []
+            overlap_used = 0
+            for previous in reversed(current):
+                if overlap_used + previous[2] > overlap_tokens or overlap_used + previous[2] + unit[2] > max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_used += previous[2]
+            current = overlap
+            current_tokens = overlap_used
+        current.append(unit)
+        current_tokens += unit[2]
+    if current:
+        chunks.append(_make_chunk(text, page_num, current[0][0], current[-1][1]))
+    return [chunk for chunk in chunks if chunk]
+
+# Chunk with surrounding whitespace trimmed (offsets adjusted), or None if blank
+def _make_chunk(text, page_num, start, end):
+    piece = text[start:end]
+    stripped = piece.strip()
+    if not stripped:
+        return None
+    start += len(piece) - len(piece.lstrip())
+    return Chunk(stripped, page_num, start, start + len(stripped))
+
+# Function to chunk (page_num, page text) pairs, yielding chunks page by page
+def chunk_pages(pages, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    for page_num, page_text in pages:
+        yield from chunk_text(page_text, max_tokens, overlap_tokens, page_num)
@@ -0,0 +1,93 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+from local_index import get_local_index
+
+load_dotenv()
+
+# Connection pool sizing and timeouts shared by every HTTP call. The pool should
+# be at least as large as the number of concurrent workers using it.
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+# "azure" for Azure AI Search, "local" for the in-process index in local_index.py
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "azure").lower()
+# Blob transfer sizing: blobs above the single-request size are moved in blocks/ranges
+# of these sizes, several at a time
+BLOB_BLOCK_BYTES = int(os.getenv("BLOB_BLOCK_BYTES", str(4 * 1024 * 1024)))
+BLOB_SINGLE_PUT_BYTES = int(os.getenv("BLOB_SINGLE_PUT_BYTES", str(8 * 1024 * 1024)))
+BLOB_SINGLE_GET_BYTES = int(os.getenv("BLOB_SINGLE_GET_BYTES", str(8 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_sessions = {}
+_search_clients = {}
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Keep-alive session, one per name so that e.g. the Azure SDK transport and the
+# raw REST calls get separate connection pools
+def get_session(name="default"):
+    with _lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = _sessions[name] = _new_session()
+        return session
+
+# Shared SearchClient per (endpoint, index, key), using a pooled keep-alive transport.
+# With SEARCH_BACKEND=local the local index of the same name is returned instead.
+def get_search_client(index_name=None, endpoint=None, key=None):
+    index_name = index_name or os.getenv("AZURE_AISEARCH_INDEX")
+    if SEARCH_BACKEND == "local":
+        return get_local_index(index_name)
+    endpoint = endpoint or os.getenv("AZURE_AISEARCH_ENDPOINT")
+    key = key or os.getenv("AZURE_AISEARCH_KEY")
+    cache_key = (endpoint, index_name, key)
+    with _lock:
+        client = _search_clients.get(cache_key)
+        if client is None:
+            transport = RequestsTransport(
+                session=_sessions.setdefault("search", _new_session()),
+                session_owner=False,
+                connection_timeout=HTTP_CONNECT_TIMEOUT,
+                read_timeout=HTTP_READ_TIMEOUT
+            )
+            client = SearchClient(endpoint=endpoint,
+                                  index_name=index_name,
+                                  credential=AzureKeyCredential(key),
+                                  transport=transport)
+            _search_clients[cache_key] = client
+        return client
+
+# Storage connection string: AZURE_STORAGE_CONNECTION_STRING when set (e.g.
+# "UseDevelopmentStorage=true" for the Azurite emulator), otherwise built from the
+# account name and key
+def storage_connection_string():
+    connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+    if connection_string:
+        return connection_string
+    return (f"DefaultEndpointsProtocol=https;AccountName={os.getenv('AZURE_STORAGE_ACCOUNT')};"
+            f"AccountKey={os.getenv('AZURE_STORAGE_ACCOUNT_KEY')};EndpointSuffix=core.windows.net")
+
+# Container client with the shared transfer sizing
+def get_container_client(container_name=None):
+    blob_service_client = BlobServiceClient.from_connection_string(
+        storage_connection_string(),
+        max_block_size=BLOB_BLOCK_BYTES,
+        max_single_put_size=BLOB_SINGLE_PUT_BYTES,
+        max_single_get_size=BLOB_SINGLE_GET_BYTES,
+        max_chunk_get_size=BLOB_BLOCK_BYTES
+    )
+    return blob_service_client.get_container_client(container_name or os.getenv("AZURE_STORAGE_CONTAINER"))
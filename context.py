@@ -0,0 +1,95 @@
+import os
+from dotenv import load_dotenv
+from chunking import chunk_text, count_tokens
+from indexing import content_hash
+
+load_dotenv()
+
+# Token budget for the search results placed in the chat prompt
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "2000"))
+# Longer results are truncated to this many tokens, so one large chunk cannot take the
+# whole budget, and a result is not added at all when less than the minimum is left
+CHAT_CONTEXT_RESULT_TOKENS = int(os.getenv("CHAT_CONTEXT_RESULT_TOKENS", "800"))
+CHAT_CONTEXT_MIN_TOKENS = int(os.getenv("CHAT_CONTEXT_MIN_TOKENS", "100"))
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# Parts of [begin, end) not covered by any of the covered ranges
+def _uncovered(begin, end, covered):
+    pieces = [(begin, end)]
+    for covered_begin, covered_end in covered:
+        next_pieces = []
+        for piece_begin, piece_end in pieces:
+            if covered_end <= piece_begin or covered_begin >= piece_end:
+                next_pieces.append((piece_begin, piece_end))
+                continue
+            if piece_begin < covered_begin:
+                next_pieces.append((piece_begin, covered_begin))
+            if covered_end < piece_end:
+                next_pieces.append((covered_end, piece_end))
+        pieces = next_pieces
+    return pieces
+
+# Text of a result that is not already in the context, or None if it adds nothing.
+# Overlap is found from chunk_begin/chunk_end within the same document; when the
+# offsets match the chunk length the overlapping part is trimmed off.
+def _new_text(result, covered_by_document, seen_hashes):
+    text = (result.get("chunk") or "").strip()
+    if not text or content_hash(text) in seen_hashes:
+        return None
+    begin = _int_or_none(result.get("chunk_begin"))
+    end = _int_or_none(result.get("chunk_end"))
+    if begin is not None and end is not None and end > begin:
+        pieces = _uncovered(begin, end, covered_by_document.get(result.get("document_num"), []))
+        if not pieces:
+            return None
+        if pieces != [(begin, end)] and len(text) == end - begin:
+            piece_begin, piece_end = max(pieces, key=lambda piece: piece[1] - piece[0])
+            text = text[piece_begin - begin:piece_end - begin].strip()
+    return text or None
+
+# Marks a result's text and range as present in the context
+def _mark_used(result, covered_by_document, seen_hashes):
+    seen_hashes.add(content_hash((result.get("chunk") or "").strip()))
+    begin = _int_or_none(result.get("chunk_begin"))
+    end = _int_or_none(result.get("chunk_end"))
+    if begin is not None and end is not None and end > begin:
+        covered_by_document.setdefault(result.get("document_num"), []).append((begin, end))
+
+def source_marker(number, result):
+    page = result.get("page_num")
+    return f"[{number}]" + (f" (page {page})" if page not in (None, "") else "")
+
+# Function to build the prompt context from search results in rank order: duplicate
+# and overlapping chunks are dropped or trimmed, each kept chunk gets a source marker,
+# and chunks are added, truncated where they do not fit, until the token budget is used.
+# Returns (context, used results).
+def build_context(search_results, max_tokens=CHAT_CONTEXT_TOKENS, result_tokens=CHAT_CONTEXT_RESULT_TOKENS,
+                  min_tokens=CHAT_CONTEXT_MIN_TOKENS):
+    min_tokens = min(min_tokens, max_tokens)
+    sections = []
+    used = []
+    remaining = max_tokens
+    covered_by_document = {}
+    seen_hashes = set()
+    for result in search_results:
+        if remaining <= 0 or remaining < min_tokens:
+            break
+        text = _new_text(result, covered_by_document, seen_hashes)
+        if text is None:
+            continue
+        section = f"{source_marker(len(sections) + 1, result)} {text}"
+        tokens = count_tokens(section) + 1  # separator
+        limit = min(remaining, max(result_tokens, min_tokens))
+        if tokens > limit:
+            section = chunk_text(section, max_tokens=max(limit - 1, 1), overlap_tokens=0)[0].text
+            tokens = limit
+        sections.append(section)
+        used.append(result)
+        _mark_used(result, covered_by_document, seen_hashes)
+        remaining -= tokens
+    return "\n\n".join(sections), used
@@ -20,7 +20,11 @@ from azure.search.documents.indexes.models import (
     ExhaustiveKnnParameters,
     VectorSearchAlgorithmMetric,
     VectorSearchAlgorithmKind,
-    VectorSearchProfile
+    VectorSearchProfile,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    BinaryQuantizationCompression,
+    RescoringOptions
 )
 import logging
 #from azure.search.documents import SearchServiceClient
@@ -48,6 +52,17 @@ for var in required_vars:
 
 credential = AzureKeyCredential(admin_key)
 
+# Must match the size of the vectors embeddings.py requests
+EMBEDDING_DIMENSIONS = int(os.getenv("AZURE_EMBEDDING_DIMENSIONS"))
+# Vector compression: "none", "scalar" (int8, 4x smaller) or "binary" (1 bit per
+# dimension, 32x smaller). Compressed vectors are searched first, then the top
+# k * oversampling candidates are rescored against the full-precision originals.
+VECTOR_COMPRESSION = os.getenv("AZURE_VECTOR_COMPRESSION", "none").lower()
+VECTOR_OVERSAMPLING = float(os.getenv("AZURE_VECTOR_OVERSAMPLING", "4"))
+# "preserveOriginals" keeps full-precision vectors for rescoring, "discardOriginals"
+# drops them for the smallest index at some loss of recall
+VECTOR_RESCORE_STORAGE = os.getenv("AZURE_VECTOR_RESCORE_STORAGE", "preserveOriginals")
+
 
 # Define the semantic configuration
 semantic_config = SemanticConfiguration(
@@ -61,8 +76,8 @@ index_client = SearchIndexClient(endpoint=endpoint, credential=credential)
 
 fields = [
     SimpleField(name="id", type=SearchFieldDataType.String, key=True),
-    SearchableField(name="document_num", type=SearchFieldDataType.String),
-    SearchableField(name="page_num", type=SearchFieldDataType.String),
+    SearchableField(name="document_num", type=SearchFieldDataType.String, filterable=True),
+    SearchableField(name="page_num", type=SearchFieldDataType.String, filterable=True),
     SearchableField(name="chunk_num", type=SearchFieldDataType.String),
     SearchableField(name="chunk_begin", type=SearchFieldDataType.String),
     SearchableField(name="chunk_end", type=SearchFieldDataType.String),
@@ -71,12 +86,37 @@ fields = [
     SearchField(
         name="embeddings",
         type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-        vector_search_dimensions=3072,
+        vector_search_dimensions=EMBEDDING_DIMENSIONS,
         vector_search_configuration="vector-config",
         vector_search_profile_name="default"
     )
 ]
 
+# Function to define the vector compression configuration, or None for full-precision vectors
+def build_compression():
+    if VECTOR_COMPRESSION == "none":
+        return None
+    rescoring_options = RescoringOptions(
+        enable_rescoring=VECTOR_RESCORE_STORAGE == "preserveOriginals",
+        default_oversampling=VECTOR_OVERSAMPLING,
+        rescore_storage_method=VECTOR_RESCORE_STORAGE
+    )
+    if VECTOR_COMPRESSION == "scalar":
+        return ScalarQuantizationCompression(
+            compression_name="default-compression",
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            rescoring_options=rescoring_options
+        )
+    if VECTOR_COMPRESSION == "binary":
+        return BinaryQuantizationCompression(
+            compression_name="default-compression",
+            rescoring_options=rescoring_options
+        )
+    raise ValueError("Invalid AZURE_VECTOR_COMPRESSION. Use 'none', 'scalar' or 'binary'.")
+
+compression = build_compression()
+compression_name = compression.compression_name if compression else None
+
 # Define VectorSearch configuration
 vector_search = VectorSearch(
     algorithms=[
@@ -99,12 +139,15 @@ vector_search = VectorSearch(
         VectorSearchProfile(
             name="default",
             algorithm_configuration_name="default",
+            compression_name=compression_name,
         ),
         VectorSearchProfile(
             name="default-HNSW",
             algorithm_configuration_name="default-HNSW",
+            compression_name=compression_name,
         ),
     ],
+    compressions=[compression] if compression else None,
 )
 
 index = SearchIndex(
@@ -116,7 +159,7 @@ index = SearchIndex(
 # Create or update the index
 index_client.create_or_update_index(index)
 
-print(f"Index '{index_name}' created or updated successfully.")
+print(f"Index '{index_name}' created or updated successfully ({EMBEDDING_DIMENSIONS} dimensions, compression: {VECTOR_COMPRESSION}).")
 
 '''
 
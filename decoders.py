@@ -0,0 +1,144 @@
+import os
+import re
+import codecs
+import logging
+import zipfile
+import xml.etree.ElementTree as ET
+from io import BytesIO
+import chardet
+import fitz  # PyMuPDF
+from bs4 import BeautifulSoup
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+logger = logging.getLogger(__name__)
+
+# Bytes handed to chardet when a document is not valid UTF-8; detection cost stays
+# constant however large the file is
+ENCODING_SAMPLE_BYTES = 64 * 1024
+# Leading bytes inspected to tell text from binary and to find an HTML charset
+SNIFF_BYTES = 4096
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+PDF_MAGIC = b"%PDF-"
+DOCX_MAIN_PART = "word/document.xml"
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+HTML_START = re.compile(rb"^\s*(<!doctype\s+html|<html|<head|<body)", re.IGNORECASE)
+HTML_CHARSET = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?([A-Za-z0-9_-]+)", re.IGNORECASE)
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".json", ".xml"}
+HTML_EXTENSIONS = {".html", ".htm"}
+
+class UnsupportedFormatError(ValueError):
+    pass
+
+def _codec(name):
+    try:
+        return codecs.lookup(name).name
+    except (LookupError, TypeError):
+        return None
+
+# Function to turn bytes into text. A byte order mark settles the encoding, then UTF-8
+# is tried (a single pass in C); only when that fails is chardet run, on a sample
+# starting near the first invalid byte rather than on the whole document.
+def decode_text(data):
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data[len(bom):].decode(encoding, errors="replace")
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        start = max(0, e.start - ENCODING_SAMPLE_BYTES // 2)
+        sample = data[start:start + ENCODING_SAMPLE_BYTES]
+    encoding = _codec(chardet.detect(sample)["encoding"])
+    # chardet reports ascii or utf-8 for samples with a few stray bytes; windows-1252
+    # is the usual encoding of such files and decodes every byte
+    if encoding in (None, "ascii", "utf-8"):
+        encoding = "cp1252"
+    logger.debug(f"Decoding as {encoding}")
+    return data.decode(encoding, errors="replace")
+
+def _is_binary(head):
+    return b"\x00" in head and not any(head.startswith(bom) for bom, _ in BOMS)
+
+# Function to work out the format of a document: "pdf", "docx", "html" or "text".
+# Magic bytes win over the content type and file name, which are often generic
+# (application/octet-stream) or wrong. Raises UnsupportedFormatError for other binary files.
+def detect_format(data, content_type=None, name=None):
+    head = data[:SNIFF_BYTES]
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    extension = os.path.splitext(name or "")[1].lower()
+    if head.startswith(PDF_MAGIC):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(BytesIO(data)) as archive:
+                if DOCX_MAIN_PART in archive.namelist():
+                    return "docx"
+        except zipfile.BadZipFile:
+            pass
+        raise UnsupportedFormatError(f"Unsupported archive {name or ''}".strip())
+    if _is_binary(head):
+        raise UnsupportedFormatError(f"Unsupported binary content {content_type or name or ''}".strip())
+    if content_type in ("text/html", "application/xhtml+xml") or extension in HTML_EXTENSIONS or HTML_START.match(head):
+        return "html"
+    if content_type.startswith("text/") or extension in TEXT_EXTENSIONS or not content_type:
+        return "text"
+    if content_type in ("application/json", "application/xml", "application/octet-stream"):
+        return "text"
+    raise UnsupportedFormatError(f"Unsupported content type {content_type}")
+
+def decode_pdf(data):
+    with fitz.open(stream=data, filetype="pdf") as pdf_document:
+        return [(page_num, pdf_document.load_page(page_num).get_text()) for page_num in range(len(pdf_document))]
+
+# Paragraph text of word/document.xml; tabs and line breaks inside a paragraph are kept
+def decode_docx(data):
+    with zipfile.ZipFile(BytesIO(data)) as archive:
+        root = ET.fromstring(archive.read(DOCX_MAIN_PART))
+    paragraphs = []
+    for paragraph in root.iter(f"{WORD_NAMESPACE}p"):
+        parts = []
+        for element in paragraph.iter():
+            if element.tag == f"{WORD_NAMESPACE}t":
+                parts.append(element.text or "")
+            elif element.tag == f"{WORD_NAMESPACE}tab":
+                parts.append("\t")
+            elif element.tag in (f"{WORD_NAMESPACE}br", f"{WORD_NAMESPACE}cr"):
+                parts.append("\n")
+        paragraphs.append("".join(parts))
+    return [(0, "\n".join(paragraphs))]
+
+def decode_html(data):
+    match = HTML_CHARSET.search(data[:SNIFF_BYTES])
+    encoding = _codec(match.group(1).decode("ascii")) if match else None
+    html = data.decode(encoding, errors="replace") if encoding else decode_text(data)
+    soup = BeautifulSoup(html, HTML_PARSER)
+    for element in soup(["script", "style", "noscript"]):
+        element.decompose()
+    body = soup.body or soup
+    return [(0, body.get_text(separator='\n', strip=True))]
+
+DECODERS = {
+    "pdf": decode_pdf,
+    "docx": decode_docx,
+    "html": decode_html,
+    "text": lambda data: [(0, decode_text(data))],
+}
+
+# Function to extract text from a document as (page index, page text) pairs. PDFs have
+# one entry per page, other formats a single entry.
+def decode_document(data, content_type=None, name=None):
+    document_format = detect_format(data, content_type, name)
+    pages = DECODERS[document_format](data)
+    logger.info(f"Decoded {name or 'document'} as {document_format}: {len(pages)} pages, "
+                f"{sum(len(text) for _, text in pages)} characters")
+    return pages
@@ -0,0 +1,144 @@
+import os
+import logging
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))
+# When the cache grows past its size bound, the least recently used entries are
+# evicted until it is back under this fraction of the bound
+EVICTION_TARGET_RATIO = 0.9
+# Least recently used entries read and deleted per eviction round
+EVICTION_BATCH_SIZE = 500
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+# Content-addressed key: the same text embedded by the same deployment at the
+# same dimensions always maps to the same cache entry
+def cache_key(text, deployment, dimensions):
+    material = "\0".join([normalize_text(text), deployment or "", str(dimensions or "")])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+# On-disk embedding cache backed by SQLite. Vectors are stored as float32 blobs
+# and evicted least-recently-used once the total size exceeds max_bytes.
+class EmbeddingCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # Running total of the vector sizes, so writes do not rescan the table
+        self._total = self._stored_bytes()
+
+    def _stored_bytes(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    # Returns a dict of key -> embedding for the keys present in the cache
+    def get_many(self, keys):
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, embedding in items:
+            blob = array("f", embedding).tobytes()
+            rows.append((key, blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            # Keys are content-addressed, so a replaced entry keeps its size and only new keys grow the total
+            existing = set()
+            for start in range(0, len(rows), 500):
+                part = [row[0] for row in rows[start:start + 500]]
+                placeholders = ",".join("?" * len(part))
+                existing.update(key for (key,) in self._conn.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({placeholders})", part))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            self._total += sum(size for key, _, size, _ in {row[0]: row for row in rows}.values() if key not in existing)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    # Function to delete least recently used entries, a batch at a time, until the cache
+    # is under its target size
+    def _evict(self):
+        # Other processes may share the file; recount before deleting anything
+        self._total = self._stored_bytes()
+        if self._total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * EVICTION_TARGET_RATIO)
+        evicted = 0
+        while self._total > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT ?", (EVICTION_BATCH_SIZE,)
+            ).fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                if self._total <= target:
+                    break
+                keys.append(key)
+                self._total -= size
+            placeholders = ",".join("?" * len(keys))
+            self._conn.execute(f"DELETE FROM embeddings WHERE key IN ({placeholders})", keys)
+            self._conn.commit()
+            evicted += len(keys)
+        logger.info(f"Evicted {evicted} entries from embedding cache {self.path}")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Shared cache instance, or None when caching is disabled
+def get_embedding_cache():
+    global _cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+        return _cache
@@ -0,0 +1,246 @@
+import os
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from dotenv import load_dotenv
+from clients import HTTP_TIMEOUT, get_session
+from embedding_cache import cache_key, get_embedding_cache
+from telemetry import add_counter, record_usage, span
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 2024-02-01 is the first GA version that accepts the "dimensions" parameter
+EMBEDDINGS_API_VERSION = "2024-02-01"
+# Size of the returned vectors; must match the index field (see create.py). text-embedding-3
+# models shorten their output to this size, ada-002 supports only its native 1536, so leave
+# this unset for ada-002.
+EMBEDDING_DIMENSIONS = int(os.getenv("AZURE_EMBEDDING_DIMENSIONS")) if os.getenv("AZURE_EMBEDDING_DIMENSIONS") else None
+
+# Per-request limits of the embeddings deployment: number of entries in the
+# "input" array and total tokens across all of them
+MAX_BATCH_INPUTS = int(os.getenv("EMBEDDING_MAX_BATCH_INPUTS", "256"))
+MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "300000"))
+
+# Number of embedding requests kept in flight and retry policy for throttled/failed calls
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# Pause taken when the rate-limit headers say the remaining quota cannot cover the next request
+LOW_QUOTA_PAUSE_SECONDS = 1.0
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Shared limiter that paces all embedding requests from the rate-limit headers
+# Azure OpenAI returns (x-ratelimit-remaining-requests/tokens, Retry-After).
+class RateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+        self._remaining_requests = None
+        self._remaining_tokens = None
+
+    # Block until a request of the given size may be sent
+    def acquire(self, tokens):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._resume_at - now
+                if delay <= 0:
+                    out_of_requests = self._remaining_requests is not None and self._remaining_requests < 1
+                    out_of_tokens = self._remaining_tokens is not None and self._remaining_tokens < tokens
+                    if not (out_of_requests or out_of_tokens):
+                        if self._remaining_requests is not None:
+                            self._remaining_requests -= 1
+                        if self._remaining_tokens is not None:
+                            self._remaining_tokens -= tokens
+                        return
+                    # Quota window is exhausted; wait and let the next response refresh it
+                    delay = LOW_QUOTA_PAUSE_SECONDS * (1 + random.random())
+                    self._resume_at = now + delay
+                    self._remaining_requests = None
+                    self._remaining_tokens = None
+            time.sleep(delay)
+
+    def update(self, headers):
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        with self._lock:
+            if remaining_requests is not None:
+                self._remaining_requests = int(remaining_requests)
+            if remaining_tokens is not None:
+                self._remaining_tokens = int(remaining_tokens)
+
+    # Pause every worker, honouring Retry-After when given, otherwise exponential backoff with full jitter
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)
+        else:
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        return delay
+
+# RateLimiter whose state lives in shared memory, so worker processes that each send
+# embeddings requests pause together and share one view of the remaining quota.
+# Create it in the parent and install it in every worker with use_rate_limiter().
+class SharedRateLimiter(RateLimiter):
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context()
+        self._lock = context.Lock()
+        # resume_at, remaining requests, remaining tokens; -1 means unknown
+        self._state = context.Array("d", [0.0, -1.0, -1.0], lock=False)
+
+    @property
+    def _resume_at(self):
+        return self._state[0]
+
+    @_resume_at.setter
+    def _resume_at(self, value):
+        self._state[0] = value
+
+    @property
+    def _remaining_requests(self):
+        return None if self._state[1] < 0 else self._state[1]
+
+    @_remaining_requests.setter
+    def _remaining_requests(self, value):
+        self._state[1] = -1.0 if value is None else value
+
+    @property
+    def _remaining_tokens(self):
+        return None if self._state[2] < 0 else self._state[2]
+
+    @_remaining_tokens.setter
+    def _remaining_tokens(self, value):
+        self._state[2] = -1.0 if value is None else value
+
+rate_limiter = RateLimiter()
+
+def use_rate_limiter(limiter):
+    global rate_limiter
+    rate_limiter = limiter
+
+def parse_retry_after(headers):
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "Retry-After" in headers:
+            return float(headers["Retry-After"])
+    except ValueError:
+        pass
+    return None
+
+def embeddings_url():
+    return f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('MODEL_EMBEDDINGS_DEPLOYMENT_NAME')}/embeddings?api-version={EMBEDDINGS_API_VERSION}"
+
+# Rough token estimate (~4 characters per token) used to keep batches under the token limit
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# Function to group texts into batches that respect the input-count and token limits.
+# Yields lists of indexes into texts.
+def iter_batches(texts, max_inputs=MAX_BATCH_INPUTS, max_tokens=MAX_BATCH_TOKENS):
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+def post_embeddings(inputs):
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv("AZURE_OPENAI_KEY")
+    }
+    payload = {
+        "input": inputs,
+        "model": os.getenv("MODEL_EMBEDDINGS_DEPLOYMENT_NAME")
+    }
+    if EMBEDDING_DIMENSIONS:
+        payload["dimensions"] = EMBEDDING_DIMENSIONS
+    tokens = sum(estimate_tokens(text) for text in inputs)
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        rate_limiter.acquire(tokens)
+        try:
+            with span("embedding", inputs=len(inputs)) as s:
+                response = get_session().post(embeddings_url(), headers=headers, json=payload, timeout=HTTP_TIMEOUT)
+                s.set_attribute("status_code", response.status_code)
+            rate_limiter.update(response.headers)
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < EMBEDDING_MAX_RETRIES:
+                delay = rate_limiter.backoff(attempt, parse_retry_after(response.headers))
+                logger.warning(f"Embeddings request returned {response.status_code}, retrying in {delay:.1f}s")
+                continue
+            response.raise_for_status()
+            result = response.json()
+            add_counter("embedding_inputs_total", len(inputs))
+            record_usage("embedding", result.get("usage"))
+            return result
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= EMBEDDING_MAX_RETRIES:
+                logger.error(f"Error generating embeddings: {e}")
+                raise
+            delay = rate_limiter.backoff(attempt)
+            logger.warning(f"Embeddings request failed ({e}), retrying in {delay:.1f}s")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error generating embeddings: {e.response.text if e.response is not None else e}")
+            raise
+
+# Function to embed many texts with one request per batch, keeping up to max_workers
+# batches in flight. Texts already in the embedding cache (and duplicates within
+# texts) are not sent. The service may return data out of order, so each item is
+# mapped back to its text through data[i].index.
+def generate_embeddings_batch(texts, max_workers=EMBEDDING_CONCURRENCY):
+    cache = get_embedding_cache()
+    deployment = os.getenv("MODEL_EMBEDDINGS_DEPLOYMENT_NAME")
+    keys = [cache_key(text, deployment, EMBEDDING_DIMENSIONS) for text in texts]
+    by_key = cache.get_many(keys) if cache else {}
+
+    first_index = {}
+    for i, key in enumerate(keys):
+        first_index.setdefault(key, i)
+    pending_keys = [key for key in first_index if key not in by_key]
+    pending_texts = [texts[first_index[key]] for key in pending_keys]
+    if cache:
+        hits = sum(1 for key in keys if key in by_key)
+        logger.info(f"Embedding cache hits: {hits}/{len(texts)}")
+
+    embeddings = [None] * len(pending_texts)
+    batches = list(iter_batches(pending_texts))
+
+    def embed_batch(batch):
+        data = post_embeddings([pending_texts[i] for i in batch])['data']
+        for item in data:
+            embeddings[batch[item['index']]] = item['embedding']
+        if cache:
+            cache.put_many((pending_keys[i], embeddings[i]) for i in batch if embeddings[i] is not None)
+        return batch
+
+    if len(batches) == 1 or max_workers <= 1:
+        for batch in batches:
+            embed_batch(batch)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(embed_batch, batch) for batch in batches]
+            for done, future in enumerate(as_completed(futures), start=1):
+                batch = future.result()
+                logger.info(f"Embedded batch {done}/{len(batches)} ({len(batch)} inputs)")
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        raise ValueError(f"Embeddings response is missing {len(missing)} inputs")
+    by_key.update(zip(pending_keys, embeddings))
+    return [by_key[key] for key in keys]
+
+def generate_embeddings(text):
+    return generate_embeddings_batch([text])[0]
@@ -0,0 +1,211 @@
+import os
+import json
+import logging
+import hashlib
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from dotenv import load_dotenv
+from embedding_cache import normalize_text
+from telemetry import span
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Azure AI Search accepts at most 1000 actions and 16 MB per indexing request
+MAX_ACTIONS_PER_BATCH = 1000
+UPLOAD_MAX_BATCH_DOCUMENTS = int(os.getenv("UPLOAD_MAX_BATCH_DOCUMENTS", str(MAX_ACTIONS_PER_BATCH)))
+UPLOAD_MAX_BATCH_BYTES = int(os.getenv("UPLOAD_MAX_BATCH_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+UPLOAD_MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", "5"))
+UPLOAD_BACKOFF_BASE_SECONDS = 1.0
+UPLOAD_BACKOFF_MAX_SECONDS = 30.0
+# Fields that locate a chunk in its document; they change when earlier text changes length
+CHUNK_POSITION_FIELDS = ["chunk_num", "chunk_begin", "chunk_end"]
+# Per-document statuses worth retrying: version conflict, index temporarily
+# unavailable, throttled, service busy
+RETRYABLE_INDEXING_STATUS_CODES = {409, 422, 429, 503}
+RETRYABLE_HTTP_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Deterministic id built from its parts. Hex digests only use characters that are
+# valid in a search document key.
+def stable_id(*parts):
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+def content_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+# The same source always maps to the same document_num
+def document_id(source):
+    return stable_id("document", source)
+
+# The id changes only when the chunk's text changes. occurrence tells apart
+# identical chunks repeated on the same page.
+def chunk_id(document_num, page_num, text, occurrence=0):
+    return stable_id(document_num, page_num, content_hash(text), occurrence)
+
+def odata_quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Function to build an OData filter restricting a search to a document and/or page,
+# or None when neither is given
+def build_filter(document_num=None, page_num=None):
+    clauses = [f"{field} eq {odata_quote(value)}"
+               for field, value in [("document_num", document_num), ("page_num", page_num)]
+               if value not in (None, "")]
+    return " and ".join(clauses) or None
+
+# Function to fetch the ids of all chunks currently indexed for a document
+def get_existing_chunk_ids(search_client, document_num):
+    results = search_client.search(
+        search_text="*",
+        filter=f"document_num eq {odata_quote(document_num)}",
+        select=["id"]
+    )
+    return {result["id"] for result in results}
+
+# Function to fetch every chunk indexed for a document as {id: {position field: value}}
+def get_existing_chunks(search_client, document_num):
+    results = search_client.search(
+        search_text="*",
+        filter=f"document_num eq {odata_quote(document_num)}",
+        select=["id"] + CHUNK_POSITION_FIELDS
+    )
+    return {result["id"]: {field: result.get(field) for field in CHUNK_POSITION_FIELDS} for result in results}
+
+# Function to find the unchanged chunks whose position in the document moved, e.g.
+# because an earlier page grew. Returns metadata-only documents for a "merge" upload,
+# so the stored offsets stay document-relative without re-embedding anything.
+def moved_chunks(existing, documents):
+    moved = []
+    for document in documents:
+        known = existing.get(document["id"])
+        if known is None:
+            continue
+        position = {field: document[field] for field in CHUNK_POSITION_FIELDS}
+        if known != position:
+            moved.append({"id": document["id"], **position})
+    return moved
+
+# Function to delete chunks by id in batches
+def delete_chunks(search_client, ids):
+    ids = list(ids)
+    for start in range(0, len(ids), MAX_ACTIONS_PER_BATCH):
+        batch = ids[start:start + MAX_ACTIONS_PER_BATCH]
+        search_client.delete_documents(documents=[{"id": id} for id in batch])
+    logger.info(f"Deleted {len(ids)} stale chunks")
+
+# Serialized size of a document in an indexing request
+def document_size(document):
+    return len(json.dumps(document, separators=(",", ":")))
+
+# Function to split documents into batches bounded by count and serialized bytes
+def iter_upload_batches(documents, max_documents=UPLOAD_MAX_BATCH_DOCUMENTS, max_bytes=UPLOAD_MAX_BATCH_BYTES):
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        size = document_size(document)
+        if batch and (len(batch) >= max_documents or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def _backoff(attempt):
+    time.sleep(random.uniform(0, min(UPLOAD_BACKOFF_MAX_SECONDS, UPLOAD_BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+# Running totals for an upload, shared by all batches
+class UploadStats:
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = []  # (key, status code, error message)
+        self.pages = 0  # pages read, counted by callers that stream pages
+        self.started = time.monotonic()
+
+    def documents_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.succeeded / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f"{self.succeeded} documents indexed, {len(self.failed)} failed, "
+                f"{self.documents_per_second():.1f} documents/s")
+
+# Function to upload one batch with mergeOrUpload (or another action, e.g. "merge" to
+# update fields of existing documents). Documents whose IndexingResult failed with a
+# retryable status are resent (and only those), with backoff.
+# Returns (succeeded count, [(key, status code, error message), ...]).
+def upload_batch(search_client, batch, key_field="id", action="merge_or_upload"):
+    send = getattr(search_client, f"{action}_documents")
+    pending = batch
+    succeeded = 0
+    failed = []
+    for attempt in range(UPLOAD_MAX_RETRIES + 1):
+        last_attempt = attempt >= UPLOAD_MAX_RETRIES
+        try:
+            with span("upload", documents=len(pending)) as s:
+                results = send(documents=pending)
+                s.add_items(len(pending))
+        except (ServiceRequestError, ServiceResponseError) as e:
+            if last_attempt:
+                return succeeded, failed + [(d[key_field], None, str(e)) for d in pending]
+            logger.warning(f"Upload of {len(pending)} documents failed ({e}), retrying")
+            _backoff(attempt)
+            continue
+        except HttpResponseError as e:
+            if e.status_code not in RETRYABLE_HTTP_STATUS_CODES or last_attempt:
+                return succeeded, failed + [(d[key_field], e.status_code, e.message) for d in pending]
+            logger.warning(f"Upload of {len(pending)} documents returned {e.status_code}, retrying")
+            _backoff(attempt)
+            continue
+        by_key = {document[key_field]: document for document in pending}
+        retry = []
+        for result in results:
+            if result.succeeded:
+                succeeded += 1
+            elif result.status_code in RETRYABLE_INDEXING_STATUS_CODES and not last_attempt:
+                retry.append(by_key[result.key])
+            else:
+                failed.append((result.key, result.status_code, result.error_message))
+        if not retry:
+            break
+        logger.warning(f"Retrying {len(retry)} of {len(pending)} documents")
+        pending = retry
+        _backoff(attempt)
+    return succeeded, failed
+
+# Function to upload documents in size-aware batches with up to concurrency batches
+# in flight. documents may be a stream; batches are formed as it is consumed.
+# Yields the number of documents indexed by each batch as it completes.
+def upload_documents(search_client, documents, stats=None, concurrency=UPLOAD_CONCURRENCY, action="merge_or_upload"):
+    stats = stats if stats is not None else UploadStats()
+
+    def collect(future):
+        succeeded, failed = future.result()
+        stats.succeeded += succeeded
+        stats.failed.extend(failed)
+        for key, status_code, message in failed:
+            logger.error(f"Failed to index document {key}: {status_code} {message}")
+        return succeeded
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        for batch in iter_upload_batches(documents):
+            in_flight.append(executor.submit(upload_batch, search_client, batch, action=action))
+            if len(in_flight) >= concurrency:
+                yield collect(in_flight.popleft())
+        while in_flight:
+            yield collect(in_flight.popleft())
+    logger.info(f"Upload finished: {stats.summary()}")
+
+# Function to upload a list of documents and return the UploadStats
+def upload_all(search_client, documents, concurrency=UPLOAD_CONCURRENCY, action="merge_or_upload"):
+    stats = UploadStats()
+    for _ in upload_documents(search_client, documents, stats, concurrency, action):
+        pass
+    return stats
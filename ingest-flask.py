@@ -2,16 +2,20 @@ import msal
 import requests
 import logging
 import traceback
-from flask import Flask, request, redirect, session, url_for, send_file, make_response
+from flask import Flask, request, redirect, session, url_for, send_file, jsonify
 from io import BytesIO
 from dotenv import load_dotenv
 import os
-import uuid
-import re
-import chardet
 from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from clients import HTTP_TIMEOUT, get_search_client, get_session
+from chunking import SENTENCE_CHUNK_MAX_TOKENS, SENTENCE_CHUNK_OVERLAP_TOKENS, chunk_sentences
+from decoders import UnsupportedFormatError, decode_document
+from embeddings import EMBEDDING_CONCURRENCY, MAX_BATCH_INPUTS, generate_embeddings_batch
+from indexing import (UploadStats, chunk_id, delete_chunks, document_id, get_existing_chunk_ids, get_existing_chunks,
+                      moved_chunks, upload_all, upload_documents)
+from jobs import JobQueue, QueueFullError
+from pipeline import batched
+from sharepoint_sync import LibrarySync
 
 load_dotenv()
 app = Flask(__name__)
@@ -23,6 +27,8 @@ client_id = "REDACTED"
 authority = f"https://login.microsoftonline.com/{tenant_id}"
 scope = ["https://.sharepoint.com/.default"]
 site_url = "https://.sharepoint.com/sites/"
+library_path = "/sites/AIRecipes/Shared Documents"
+library_title = "Documents"
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -48,8 +54,7 @@ required_vars = [
     "AZURE_STORAGE_ACCOUNT_KEY",
     "AZURE_STORAGE_CONTAINER",
     "PUBLIC_URL",
-    "BLOB_NAME",
-    "PAGE_NUM"
+    "BLOB_NAME"
 ]
  
 for var in required_vars:
@@ -58,13 +63,16 @@ for var in required_vars:
         raise ValueError(f"Missing required environment variable: {var}")
 
 BLOB_FILE_NAME = f"{os.getenv("BLOB_NAME")}"
-PAGE_NUM = int(os.getenv("PAGE_NUM"))
 
 SEARCH_SERVICE_ENDPOINT = os.getenv("AZURE_AISEARCH_ENDPOINT")
 SEARCH_API_KEY = f"{os.getenv("AZURE_AISEARCH_KEY")}"
 SEARCH_INDEX_NAME = f"{os.getenv("AZURE_AISEARCH_INDEX")}"
 print(SEARCH_INDEX_NAME)
 
+# Documents are ingested by background workers so requests return immediately
+job_queue = JobQueue()
+library_sync = LibrarySync(site_url, library_path, library_title)
+
 @app.route('/')
 def index():
     auth_url = msal_app.get_authorization_request_url(scopes=scope)
@@ -93,7 +101,7 @@ def test_authentication():
     }
 
     try:
-        response = requests.get(f"{site_url}/_api/web/lists", headers=headers)
+        response = get_session().get(f"{site_url}/_api/web/lists", headers=headers, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         lists = response.json()
         return f"{lists}"
@@ -115,7 +123,7 @@ def get_document(file_name):
 
     try:
         # Get the file content
-        response = requests.get(f"{site_url}/_api/web/GetFolderByServerRelativeUrl('/sites/AIRecipes/Shared Documents')/Files('{file_name}')/$value", headers=headers)
+        response = get_session().get(f"{site_url}/_api/web/GetFolderByServerRelativeUrl('{library_path}')/Files('{file_name}')/$value", headers=headers, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         file_content = response.content
 
@@ -126,43 +134,132 @@ def get_document(file_name):
     except Exception as e:
         return f"Failed to get document: {e}\n{traceback.format_exc()}"
 
-def split_text_into_chunks(text, max_tokens):
-    words = text.split()
-    chunks = []
-    current_chunk = []
+# Function to download one SharePoint document and ingest it, run by a job worker
+def ingest_file(job, file_name, token):
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/json;odata=verbose"
+    }
 
-    for word in words:
-        current_chunk.append(word)
-        if len(current_chunk) >= max_tokens:
-            chunks.append(' '.join(current_chunk))
-            current_chunk = []
+    # Get the file content
+    response = get_session().get(f"{site_url}/_api/web/GetFolderByServerRelativeUrl('{library_path}')/Files('{file_name}')/$value", headers=headers, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
 
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
+    return ingest_content(job, f"{library_path}/{file_name}", response.content, response.headers.get("Content-Type"))
 
-    return chunks
+# Function to ingest a file already synced to disk, run by a job worker
+def ingest_path(job, source, path):
+    with open(path, "rb") as f:
+        return ingest_content(job, source, f.read())
 
-def generate_embeddings(text):
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": os.getenv("AZURE_OPENAI_KEY")
-    }
-    payload = {
-        "input": text,
-        "model": os.getenv("MODEL_EMBEDDINGS_DEPLOYMENT_NAME")
-    }
+# Function to decode, chunk, embed and upload a document. source is its server-relative
+# URL; chunk ids derive from it, so re-ingesting a changed file only sends new or
+# changed chunks and deletes the ones no longer in it. Progress is recorded on the job.
+def ingest_content(job, source, file_content, content_type=None):
+    document_num = document_id(source)
+    # PDF, DOCX, HTML and text are decoded by format; other binary files are not indexed
     try:
-        response = requests.post(
-            f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('MODEL_EMBEDDINGS_DEPLOYMENT_NAME')}/embeddings?api-version=2023-05-15",
-            headers=headers,
-            json=payload
-        )
-        #print(response.json())
-        response.raise_for_status()
-        return response.json()['data'][0]['embedding']
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error generating embeddings: {e.response.text}")
-        raise
+        pages = decode_document(file_content, content_type, source)
+    except UnsupportedFormatError as e:
+        job.error(f"Skipped {source}: {e}")
+        return {"document_num": document_num, "skipped": str(e)}
+
+    search_client = get_search_client(SEARCH_INDEX_NAME, SEARCH_SERVICE_ENDPOINT, SEARCH_API_KEY)
+    existing = get_existing_chunks(search_client, document_num)
+
+    # Consecutive sentences of each page are packed into token-budgeted, overlapping
+    # chunks; chunk offsets are into the whole document text
+    chunks = []
+    page_offset = 0
+    for page_index, page_text in pages:
+        for chunk in chunk_sentences(page_text, SENTENCE_CHUNK_MAX_TOKENS, SENTENCE_CHUNK_OVERLAP_TOKENS, page_num=page_index):
+            chunks.append(chunk._replace(start=page_offset + chunk.start, end=page_offset + chunk.end))
+        page_offset += len(page_text)
+    job.add("chunks_total", len(chunks))
+    logger.info(f"Split {source} into {len(chunks)} chunks")
+    # Same ids as ingest.py: page index, text and repeat count of the text on its page
+    ids = []
+    occurrences = {}
+    for chunk in chunks:
+        occurrence = occurrences.get((chunk.page_num, chunk.text), 0)
+        occurrences[(chunk.page_num, chunk.text)] = occurrence + 1
+        ids.append(chunk_id(document_num, chunk.page_num, chunk.text, occurrence))
+    pending = [(i, chunk) for i, chunk in enumerate(chunks) if ids[i] not in existing]
+    job.add("chunks_unchanged", len(chunks) - len(pending))
+    # Unchanged chunks after text that changed length only get their new position
+    moved = moved_chunks(existing, [
+        {"id": ids[i], "chunk_num": str(i), "chunk_begin": str(chunk.start), "chunk_end": str(chunk.end)}
+        for i, chunk in enumerate(chunks) if ids[i] in existing
+    ])
+    documents = []
+
+    # Embed in groups large enough to keep every embedding worker busy
+    for group in batched(pending, MAX_BATCH_INPUTS * EMBEDDING_CONCURRENCY):
+        try:
+            group_embeddings = generate_embeddings_batch([chunk.text for _, chunk in group])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            job.add("chunks_failed", len(group))
+            job.error(f"Failed to generate embeddings for chunks {group[0][0]}-{group[-1][0]}: {e}")
+            continue
+        for (i, chunk), embeddings in zip(group, group_embeddings):
+            documents.append({
+                "@search.action": "mergeOrUpload",
+                "id": ids[i],
+                "document_num": document_num,
+                "page_num": str(chunk.page_num + 1),
+                "chunk_num": str(i),
+                "chunk_begin": str(chunk.start),
+                "chunk_end": str(chunk.end),
+                "chunk": chunk.text,
+                "embeddings": embeddings
+            })
+        job.add("chunks_embedded", len(group))
+
+    # Upload documents to Azure Cognitive Search
+    stats = UploadStats()
+    for indexed in upload_documents(search_client, documents, stats):
+        job.add("chunks_uploaded", indexed)
+    if moved:
+        stats.failed.extend(upload_all(search_client, moved, action="merge").failed)
+    if stats.failed:
+        job.add("chunks_failed", len(stats.failed))
+        for key, status_code, message in stats.failed[:5]:
+            job.error(f"Failed to upload {key}: {status_code} {message}")
+
+    # Remove chunks that are no longer in the document
+    stale_ids = set(existing) - set(ids)
+    if stale_ids:
+        delete_chunks(search_client, stale_ids)
+
+    logger.info(f"Documents uploaded. {stats.summary()}")
+    return {"document_num": document_num, "upload": stats.summary(), "chunks_moved": len(moved),
+            "stale_chunks_deleted": len(stale_ids)}
+
+# Function to remove every chunk of a document deleted from the library
+def remove_document(source):
+    search_client = get_search_client(SEARCH_INDEX_NAME, SEARCH_SERVICE_ENDPOINT, SEARCH_API_KEY)
+    ids = get_existing_chunk_ids(search_client, document_id(source))
+    if ids:
+        delete_chunks(search_client, ids)
+
+# Function to sync the document library, run by a job worker: only new or modified
+# files are downloaded, and each is queued as its own ingestion job. A file whose
+# ingestion job fails is downloaded and ingested again on the next sync.
+def sync_library(job, token):
+    queued = []
+
+    def on_changed(url, path):
+        def on_ingested(ingest_job):
+            if ingest_job.state == "failed":
+                library_sync.retry_later(url)
+
+        queued.append(job_queue.submit(url, lambda ingest_job: ingest_path(ingest_job, url, path), on_ingested).id)
+
+    summary = library_sync.sync(token, on_changed, remove_document)
+    for url in summary["failed"]:
+        job.error(f"Failed to sync {url}")
+    job.add("chunks_failed", len(summary["failed"]))
+    return dict(summary, jobs=queued)
 
 @app.route('/ingest_document/<file_name>')
 def ingest_document(file_name):
@@ -170,103 +267,44 @@ def ingest_document(file_name):
     if not token:
         return "No token found in session."
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json;odata=verbose"
-    }
-
     try:
-        # Get the file content
-        response = requests.get(f"{site_url}/_api/web/GetFolderByServerRelativeUrl('/sites/AIRecipes/Shared Documents')/Files('{file_name}')/$value", headers=headers)
-        response.raise_for_status()
-
-        file_content = response.content
-
-        # Detect encoding
-        detected_encoding = chardet.detect(file_content)['encoding']
-        print(f"Detected encoding: {detected_encoding}")
+        job = job_queue.submit(file_name, lambda job: ingest_file(job, file_name, token))
+    except QueueFullError as e:
+        response = jsonify({"error": f"Ingestion queue is full, retry later ({e})"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+    status_url = url_for('get_job', job_id=job.id)
+    response = jsonify({"job_id": job.id, "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202
+
+@app.route('/sync_library')
+def sync_library_route():
+    token = session.get('token')
+    if not token:
+        return "No token found in session."
 
-        # Try decoding with detected encoding or common encodings
-        try:
-            if detected_encoding:
-                file_text = file_content.decode(detected_encoding)
-            else:
-                file_text = file_content.decode('utf-8')
-        except (UnicodeDecodeError, TypeError):
-            try:
-                file_text = file_content.decode('latin-1')
-            except UnicodeDecodeError:
-                try:
-                    file_text = file_content.decode('windows-1252')
-                except UnicodeDecodeError:
-                    print("Failed to decode file content with common encodings.")
-                    file_text = ""
-        
-        #file_content = response.content
-        # Check and set encoding if necessary
-        # if response.encoding is None:
-        #     response.encoding = 'utf-8'  # Default to 'utf-8' if encoding is not specified
-        # file_text = response.text
-        # detected_encoding = chardet.detect(file_content)['encoding']
-        # # Try decoding with detected encoding or common encodings
-        # try:
-        #     if detected_encoding:
-        #         file_text = file_content.decode(detected_encoding)
-        #     else:
-        #         file_text = file_content.decode('utf-8')
-        # except (UnicodeDecodeError, TypeError):
-        #     try:
-        #         file_text = file_content.decode('latin-1')
-        #     except UnicodeDecodeError:
-        #         try:
-        #             file_text = file_content.decode('windows-1252')
-        #         except UnicodeDecodeError:
-        #             print("Failed to decode file content with common encodings.")
-        #             file_text = ""
-        document_uuid = str(uuid.uuid4())
-        MAX_TOKENS = 3000
-        # Split text into sections
-        #pattern = r'\d+\.\d*\s+'
-        #chunks = re.split(pattern, file_text)
-        sentence_endings = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s')
-        chunks = sentence_endings.split(file_text)
-        documents = []
-        current_position = 0
-
-        for i, chunk in enumerate(chunks):
-            if chunk.strip():  # Skip empty sections
-                # Split chunk into smaller chunks if necessary
-                smaller_chunks = split_text_into_chunks(chunk, MAX_TOKENS)
-                for j, small_chunk in enumerate(smaller_chunks):
-                    print(f"Chunk {i}-{j} length: {len(small_chunk.split())} tokens")
-                try:
-                    embeddings = generate_embeddings(small_chunk)
-                    document = {
-                        "@search.action": "upload",
-                        "id": str(uuid.uuid4()),
-                        "document_num": str(document_uuid),
-                        "page_num": str(PAGE_NUM),
-                        "chunk_num": f"{i}-{j}",
-                        "chunk": small_chunk,
-                        "embeddings": embeddings
-                    }
-                    documents.append(document)
-                except requests.exceptions.HTTPError as e:
-                    print(f"Failed to generate embeddings for chunk {i}-{j}: {e}")
-
-        # Initialize Search Client
-        search_client = SearchClient(endpoint=SEARCH_SERVICE_ENDPOINT, index_name=SEARCH_INDEX_NAME, credential=AzureKeyCredential(SEARCH_API_KEY))
-
-        # Upload documents to Azure Cognitive Search
-        search_client.upload_documents(documents=documents)
-
-        print("Documents uploaded successfully.")
-        response = make_response("Documents uploaded successfully.", 200)
-        return response
-    except requests.exceptions.HTTPError as e:
-        return f"Failed to get document: {e}\nResponse: {e.response.text}\n{traceback.format_exc()}"
-    except Exception as e:
-        return f"Failed to get document: {e}\n{traceback.format_exc()}"
+    try:
+        job = job_queue.submit("sync_library", lambda job: sync_library(job, token))
+    except QueueFullError as e:
+        response = jsonify({"error": f"Ingestion queue is full, retry later ({e})"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+    status_url = url_for('get_job', job_id=job.id)
+    response = jsonify({"job_id": job.id, "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify([job.to_dict() for job in job_queue.list()])
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,13 +1,22 @@
-import re
-import uuid
 import os
-import logging
-import requests
+import glob
+import json
 import time
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
-import fitz  # PyMuPDF
+from chunking import chunk_text
+from clients import SEARCH_BACKEND, get_search_client
+from decoders import PDF_MAGIC, decode_document
+from embeddings import MAX_BATCH_INPUTS, SharedRateLimiter, generate_embeddings_batch, use_rate_limiter
+from indexing import (CHUNK_POSITION_FIELDS, UploadStats, chunk_id, delete_chunks, document_id, get_existing_chunks,
+                      moved_chunks, upload_all, upload_documents)
+from pdf_extract import PDF_EXTRACT_WORKERS, iter_pdf_pages_parallel
+from pipeline import batched, run_pipeline
+from telemetry import (TELEMETRY_ENABLED, drain_metrics, log_stage_report, merge_metrics, span, start_metrics_server,
+                       timed_iter)
 
 load_dotenv()
 
@@ -31,116 +40,245 @@ for var in required_vars:
 
 # Configuration
 PDF_FILE_PATH = "content/tricare-provider-handbook.pdf"
-PAGE_NUM = int(os.getenv("PAGE_NUM", "1"))  # Default to page 1 if not specified
+# Stable identity of the source; chunk ids are derived from it so re-runs update instead of duplicating
+DOCUMENT_NAME = os.getenv("DOCUMENT_NAME")
+# In incremental mode unchanged chunks are skipped and chunks no longer in the source are deleted
+INGEST_INCREMENTAL = os.getenv("INGEST_INCREMENTAL", "false").lower() == "true"
+# Files ingested at the same time by the CLI, each in its own worker process
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Extensions picked up when a directory is given
+INGEST_EXTENSIONS = {".pdf", ".docx", ".html", ".htm", ".txt", ".md"}
 
 SEARCH_SERVICE_ENDPOINT = os.getenv("AZURE_AISEARCH_ENDPOINT")
 SEARCH_API_KEY = f"{os.getenv('AZURE_AISEARCH_KEY')}"
 SEARCH_INDEX_NAME = f"{os.getenv('AZURE_AISEARCH_INDEX')}"
-print(f"Using search index: {SEARCH_INDEX_NAME}")
 
-# Function to extract text from PDF
-def extract_text_from_pdf(pdf_path):
-    pages_text = []
+# Pipeline stage: (page index, page text) -> documents without embeddings.
+# page_num is the 1-based page the chunk came from; chunk_begin/chunk_end are
+# character offsets into the whole document text.
+# Chunks whose id is in existing are unchanged and not passed on; their id and
+# position are collected in unchanged instead. Every id produced is recorded in seen_ids.
+def make_chunk_stage(document_num, existing, seen_ids, unchanged, url=None):
+    def chunk_stage(pages):
+        page_offset = 0
+        chunk_num = 0
+        for page_index, page_text in pages:
+            occurrences = {}
+            with span("chunking") as s:
+                chunks = chunk_text(page_text, page_num=page_index)
+                s.add_items(len(chunks))
+            for chunk in chunks:
+                occurrence = occurrences.get(chunk.text, 0)
+                occurrences[chunk.text] = occurrence + 1
+                document = {
+                    "@search.action": "mergeOrUpload",
+                    "id": chunk_id(document_num, page_index, chunk.text, occurrence),
+                    "document_num": document_num,
+                    "page_num": str(page_index + 1),
+                    "chunk_num": str(chunk_num),
+                    "chunk_begin": str(page_offset + chunk.start),
+                    "chunk_end": str(page_offset + chunk.end),
+                    "chunk": chunk.text,
+                    "url": str(url or os.getenv("PUBLIC_URL")),
+                }
+                chunk_num += 1
+                seen_ids.add(document["id"])
+                if document["id"] in existing:
+                    unchanged.append({key: document[key] for key in ["id"] + CHUNK_POSITION_FIELDS})
+                else:
+                    yield document
+            page_offset += len(page_text)
+    return chunk_stage
+
+# Pipeline stage: adds embeddings to up to one request's worth of chunks at a time,
+# starting on whatever chunking has produced so far
+def embed_stage(documents):
+    for group in batched(documents, MAX_BATCH_INPUTS):
+        with span("embedding_batch") as s:
+            chunk_embeddings = generate_embeddings_batch([document["chunk"] for document in group])
+            s.add_items(len(group))
+        for document, embeddings in zip(group, chunk_embeddings):
+            document["embeddings"] = embeddings
+            yield document
+
+# Pipeline stage: uploads documents in size-aware concurrent batches and yields the number indexed per batch
+def make_upload_stage(search_client, stats):
+    def upload_stage(documents):
+        return upload_documents(search_client, documents, stats)
+    return upload_stage
+
+# Function to ingest any supported file, used by the CLI and blob_ingest.py: PDFs are
+# extracted page by page from disk, other formats are decoded in memory
+def ingest_file(path, source=None, incremental=INGEST_INCREMENTAL, url=None, content_type=None,
+                extract_workers=PDF_EXTRACT_WORKERS):
+    with open(path, "rb") as f:
+        is_pdf = f.read(len(PDF_MAGIC)) == PDF_MAGIC
+    if is_pdf:
+        logger.info(f"Extracting text from {path}")
+        pages = timed_iter("extraction", iter_pdf_pages_parallel(path, workers=extract_workers))
+    else:
+        with open(path, "rb") as f:
+            pages = decode_document(f.read(), content_type, path)
+    return ingest_pages(pages, source or path, incremental, url)
+
+# Function to ingest (page index, page text) pairs from any source through the same
+# pipeline. source is the stable identity chunk ids are derived from.
+def ingest_pages(pages, source, incremental=INGEST_INCREMENTAL, url=None):
+    search_client = get_search_client(SEARCH_INDEX_NAME, SEARCH_SERVICE_ENDPOINT, SEARCH_API_KEY)
+    document_num = document_id(source)
+    existing = get_existing_chunks(search_client, document_num) if incremental else {}
+    seen_ids = set()
+    unchanged = []
+
+    stats = UploadStats()
+    stages = [
+        make_chunk_stage(document_num, existing, seen_ids, unchanged, url),
+        embed_stage,
+        make_upload_stage(search_client, stats),
+    ]
+
+    def count_pages(pages):
+        for page in pages:
+            stats.pages += 1
+            yield page
+
+    for _ in run_pipeline(count_pages(pages), stages):
+        logger.info(f"Uploaded {stats.succeeded} documents to {SEARCH_INDEX_NAME} ({stats.documents_per_second():.1f} documents/s)")
+
+    if incremental:
+        # Unchanged chunks after text that changed length get their new position
+        moved = moved_chunks(existing, unchanged)
+        if moved:
+            stats.failed.extend(upload_all(search_client, moved, action="merge").failed)
+        # Remove chunks that no longer exist in the source
+        stale_ids = set(existing) - seen_ids
+        logger.info(f"Incremental ingest: {len(unchanged)} unchanged ({len(moved)} moved), "
+                    f"{stats.succeeded} new or changed, {len(stale_ids)} stale chunks")
+        if stale_ids:
+            delete_chunks(search_client, stale_ids)
+    if TELEMETRY_ENABLED:
+        log_stage_report(logger)
+    return stats
+
+# Function to list the files to ingest as (path, source, url). Arguments may be files,
+# directories (searched recursively for INGEST_EXTENSIONS) or glob patterns. A manifest
+# has one path per line, or a JSON object per line with "path" and optional "source"
+# and "url"; relative paths are resolved against the manifest's directory.
+def collect_files(arguments, manifest=None):
+    files = []
+    for argument in arguments:
+        if os.path.isdir(argument):
+            for root, _, names in os.walk(argument):
+                files.extend((os.path.join(root, name), None, None) for name in sorted(names)
+                             if os.path.splitext(name)[1].lower() in INGEST_EXTENSIONS)
+        elif os.path.isfile(argument):
+            files.append((argument, None, None))
+        else:
+            matches = sorted(path for path in glob.glob(argument, recursive=True) if os.path.isfile(path))
+            if not matches:
+                logger.warning(f"No files match {argument}")
+            files.extend((path, None, None) for path in matches)
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                entry = json.loads(line) if line.startswith("{") else {"path": line}
+                files.append((os.path.join(base, entry["path"]), entry.get("source"), entry.get("url")))
+    unique = {}
+    for path, source, url in files:
+        unique.setdefault(os.path.abspath(path), (path, source, url))
+    return list(unique.values())
+
+# Source of a file given on the command line: its path relative to the working
+# directory, so the same file keeps the same chunk ids between runs
+def default_source(path):
+    return os.path.relpath(path).replace(os.sep, "/")
+
+def _init_worker(limiter):
+    use_rate_limiter(limiter)
+
+# Function run for one file, in a worker process or in the CLI process itself.
+# Returns a picklable summary; failures are reported rather than raised. A worker
+# process also returns the metrics it recorded, for the parent to merge.
+def ingest_one(path, source, url, incremental, extract_workers, worker_process=False):
+    start = time.perf_counter()
+    summary = {"path": path, "pages": 0, "chunks_uploaded": 0, "chunks_failed": 0, "error": None}
     try:
-        with fitz.open(pdf_path) as pdf_document:
-            logger.info(f"PDF has {len(pdf_document)} pages")
-            for page_num in range(len(pdf_document)):
-                page = pdf_document.load_page(page_num)
-                pages_text.append(page.get_text())
+        stats = ingest_file(path, source or default_source(path), incremental, url, extract_workers=extract_workers)
+        summary.update(pages=stats.pages, chunks_uploaded=stats.succeeded, chunks_failed=len(stats.failed))
     except Exception as e:
-        logger.error(f"Error extracting text from PDF: {str(e)}")
-        raise
-    return pages_text
-
-# Extract text from the local PDF
-logger.info(f"Extracting text from {PDF_FILE_PATH}")
-pages_text = extract_text_from_pdf(PDF_FILE_PATH)
-logger.info(f"Extracted text from {len(pages_text)} pages")
-
-# Document UUID
-document_uuid = str(uuid.uuid4())
-
-def generate_embeddings(text):
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": os.getenv("AZURE_OPENAI_KEY")
-    }
-    payload = {
-        "input": text,
-        "model": os.getenv("MODEL_EMBEDDINGS_DEPLOYMENT_NAME")
-    }
-    try:
-        response = requests.post(
-            f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('MODEL_EMBEDDINGS_DEPLOYMENT_NAME')}/embeddings?api-version=2023-05-15",
-            headers=headers,
-            json=payload
-        )
-        response.raise_for_status()
-        return response.json()['data'][0]['embedding']
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error generating embeddings: {e.response.text}")
-        raise
-
-# Function to split text into chunks based on token count
-def chunk_text_by_tokens(text, max_tokens):
-    words = text.split()
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    for word in words:
-        if current_length + len(word.split()) <= max_tokens:
-            current_chunk.append(word)
-            current_length += len(word.split())
-        else:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [word]
-            current_length = len(word.split())
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
-    return chunks
-
-max_tokens = 7000
-chunks = []
-
-for page_text in pages_text:
-    if page_text.strip():  # Skip empty pages
-        chunks.extend(chunk_text_by_tokens(page_text, max_tokens))
-
-logger.info(f"Created {len(chunks)} text chunks for embedding")
-
-# Prepare documents for upload
-documents = []
-current_position = 0
-
-for i, chunk in enumerate(chunks):
-    if chunk.strip():  # Skip empty sections
-        begin = current_position
-        end = current_position + len(chunk)
-        logger.info(f"Generating embeddings for chunk {i+1}/{len(chunks)}")
-        embeddings = generate_embeddings(chunk)
-        time.sleep(0.5)  # Rate limiting
-        document = {
-            "@search.action": "upload",
-            "id": str(uuid.uuid4()),
-            "document_num": str(document_uuid),
-            "page_num": str(PAGE_NUM),
-            "chunk_num": str(i),
-            "chunk_begin": str(begin),
-            "chunk_end": str(end),
-            "chunk": str(chunk),
-            "url": str(os.getenv("PUBLIC_URL")),
-            "embeddings": embeddings
-        }
-        documents.append(document)
-        current_position = end
-
-# Initialize Search Client
-search_client = SearchClient(endpoint=SEARCH_SERVICE_ENDPOINT, 
-                            index_name=SEARCH_INDEX_NAME, 
-                            credential=AzureKeyCredential(SEARCH_API_KEY))
-
-# Upload documents to Azure Cognitive Search
-logger.info(f"Uploading {len(documents)} documents to Azure AI Search")
-search_client.upload_documents(documents=documents)
-
-logger.info("Documents uploaded successfully.")
\ No newline at end of file
+        logger.error(f"Failed to ingest {path}: {e}")
+        summary["error"] = str(e)
+    summary["seconds"] = time.perf_counter() - start
+    if worker_process:
+        summary["metrics"] = drain_metrics()
+    return summary
+
+# Function to ingest many files. With more than one worker each file is ingested in its
+# own process (PDF pages are then extracted serially inside it) and every process
+# draws on one shared embeddings rate limiter. Yields the summary of each file.
+def ingest_files(files, workers=INGEST_WORKERS, incremental=INGEST_INCREMENTAL):
+    if workers > 1 and SEARCH_BACKEND == "local":
+        # The local index keeps its vectors in one process's memory map
+        logger.warning("SEARCH_BACKEND=local cannot be written by several processes, ingesting with one worker")
+        workers = 1
+    if workers <= 1 or len(files) <= 1:
+        for path, source, url in files:
+            yield ingest_one(path, source, url, incremental, PDF_EXTRACT_WORKERS)
+        return
+    # spawn: the workers must not inherit this process's HTTP connections or threads
+    context = multiprocessing.get_context("spawn")
+    limiter = SharedRateLimiter(context)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(limiter,)) as executor:
+        futures = [executor.submit(ingest_one, path, source, url, incremental, 1, True) for path, source, url in files]
+        for future in as_completed(futures):
+            result = future.result()
+            # Spans and counters of the workers, for the metrics endpoint and stage report of this process
+            merge_metrics(result.pop("metrics"))
+            yield result
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest documents into the search index")
+    parser.add_argument("paths", nargs="*", help="files, directories or glob patterns (default: the handbook PDF)")
+    parser.add_argument("--manifest", help="file listing one path, or JSON object with path/source/url, per line")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="files ingested in parallel processes")
+    parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, default=INGEST_INCREMENTAL,
+                        help="skip unchanged chunks and delete stale ones")
+    args = parser.parse_args()
+
+    start_metrics_server()
+    logger.info(f"Using search index: {SEARCH_INDEX_NAME}")
+    if args.paths or args.manifest:
+        files = collect_files(args.paths, args.manifest)
+    else:
+        files = [(PDF_FILE_PATH, DOCUMENT_NAME, None)]
+    if not files:
+        parser.error("No files to ingest")
+
+    start = time.perf_counter()
+    results = []
+    for result in ingest_files(files, args.workers, args.incremental):
+        results.append(result)
+        status = f"failed: {result['error']}" if result["error"] else f"{result['pages']} pages, {result['chunks_uploaded']} chunks"
+        logger.info(f"[{len(results)}/{len(files)}] {result['path']}: {status} in {result['seconds']:.1f}s")
+    elapsed = time.perf_counter() - start
+
+    failed_files = [result for result in results if result["error"] or result["chunks_failed"]]
+    pages = sum(result["pages"] for result in results)
+    chunks = sum(result["chunks_uploaded"] for result in results)
+    print(f"Ingested {len(results) - len(failed_files)}/{len(results)} files in {elapsed:.1f}s with {args.workers} workers: "
+          f"{pages} pages, {chunks} chunks uploaded, {sum(result['chunks_failed'] for result in results)} chunks failed")
+    print(f"Throughput: {len(results) / elapsed:.2f} files/s, {pages / elapsed:.1f} pages/s, {chunks / elapsed:.1f} chunks/s")
+    for result in failed_files:
+        print(f"  {result['path']}: {result['error'] or str(result['chunks_failed']) + ' chunks failed to upload'}")
+    if TELEMETRY_ENABLED and len(results) > 1:
+        # Totals over all files, including those ingested by worker processes
+        log_stage_report(logger)
+    if failed_files:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
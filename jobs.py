@@ -0,0 +1,134 @@
+import os
+import logging
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Jobs run at the same time, jobs allowed to wait for a worker, and finished jobs
+# kept for status queries
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "4"))
+INGEST_JOB_MAX_QUEUED = int(os.getenv("INGEST_JOB_MAX_QUEUED", "100"))
+INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "1000"))
+MAX_JOB_ERRORS = 20
+
+class QueueFullError(Exception):
+    pass
+
+# State and progress of one background job. The worker updates the counters while
+# the web tier reads them through to_dict().
+class Job:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self._lock = threading.Lock()
+        self._counters = {"chunks_total": 0, "chunks_unchanged": 0, "chunks_embedded": 0, "chunks_uploaded": 0, "chunks_failed": 0}
+        self._errors = []
+        self._error_count = 0
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def error(self, message):
+        logger.warning(f"Job {self.id} ({self.name}): {message}")
+        with self._lock:
+            self._error_count += 1
+            if len(self._errors) < MAX_JOB_ERRORS:
+                self._errors.append(message)
+
+    def finished(self):
+        return self.state in ("succeeded", "failed")
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self._counters)
+            errors = list(self._errors)
+            error_count = self._error_count
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "id": self.id,
+            "name": self.name,
+            "state": self.state,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": elapsed,
+            **counters,
+            "chunks_per_second": counters["chunks_uploaded"] / elapsed if elapsed else 0.0,
+            "error_count": error_count,
+            "errors": errors,
+            "result": self.result
+        }
+
+# Worker pool for background jobs. submit() returns immediately; at most max_queued
+# jobs may wait for a worker, beyond that QueueFullError is raised so the caller can
+# shed load. Finished jobs are kept (oldest evicted first) up to history.
+class JobQueue:
+    def __init__(self, workers=INGEST_JOB_WORKERS, max_queued=INGEST_JOB_MAX_QUEUED, history=INGEST_JOB_HISTORY):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._queued = 0
+        self.max_queued = max_queued
+        self.history = history
+
+    # fn(job) does the work, updates job progress and returns a JSON-serializable result.
+    # on_finished(job), when given, is called once the job has succeeded or failed.
+    def submit(self, name, fn, on_finished=None):
+        job = Job(name)
+        with self._lock:
+            if self._queued >= self.max_queued:
+                raise QueueFullError(f"{self._queued} jobs are already queued")
+            self._queued += 1
+            self._jobs[job.id] = job
+            self._evict()
+        self._executor.submit(self._run, job, fn, on_finished)
+        logger.info(f"Queued job {job.id} ({name})")
+        return job
+
+    def _run(self, job, fn, on_finished=None):
+        with self._lock:
+            self._queued -= 1
+        job.state = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(job)
+            job.state = "failed" if job.to_dict()["chunks_failed"] else "succeeded"
+        except Exception as e:
+            job.error(f"{e}\n{traceback.format_exc()}")
+            job.state = "failed"
+        finally:
+            job.finished_at = time.time()
+            logger.info(f"Job {job.id} ({job.name}) {job.state}")
+        if on_finished:
+            try:
+                on_finished(job)
+            except Exception as e:
+                logger.error(f"Completion callback of job {job.id} ({job.name}) failed: {e}")
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished()]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
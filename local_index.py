@@ -0,0 +1,341 @@
+import os
+import re
+import json
+import logging
+import sqlite3
+import threading
+from typing import NamedTuple
+import numpy as np
+from dotenv import load_dotenv
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", ".cache/local_index")
+# Same vector size and metric as the "embeddings" field create.py defines
+LOCAL_INDEX_DIMENSIONS = int(os.getenv("AZURE_EMBEDDING_DIMENSIONS") or "3072")
+# Approximate search through an HNSW graph (requires hnswlib); exact search otherwise
+LOCAL_INDEX_ANN = os.getenv("LOCAL_INDEX_ANN", "false").lower() == "true"
+HNSW_M = int(os.getenv("LOCAL_INDEX_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("LOCAL_INDEX_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("LOCAL_INDEX_HNSW_EF_SEARCH", "100"))
+INITIAL_CAPACITY = 1024
+# Metadata columns that filters are evaluated on in SQL
+FILTERABLE_FIELDS = ["id", "document_num", "page_num"]
+# Constant of reciprocal rank fusion, as used by Azure AI Search hybrid queries
+RRF_K = 60
+# Keyword candidates considered when the query does not give a top
+DEFAULT_KEYWORD_CANDIDATES = 50
+
+# Same shape as the IndexingResult the Azure SDK returns
+class LocalIndexingResult(NamedTuple):
+    key: str
+    succeeded: bool
+    status_code: int
+    error_message: str = None
+
+_FILTER_CLAUSE = re.compile(r"^\s*(\w+)\s+eq\s+'((?:[^']|'')*)'\s*$")
+
+# Parses the OData subset used by this repo: field eq 'value' clauses joined by "and".
+# Returns [(field, value), ...].
+def parse_filter(expression):
+    clauses = []
+    for clause in re.split(r"\s+and\s+", expression.strip()):
+        match = _FILTER_CLAUSE.match(clause)
+        if not match or match.group(1) not in FILTERABLE_FIELDS:
+            raise ValueError(f"Unsupported filter for the local index: {clause}")
+        clauses.append((match.group(1), match.group(2).replace("''", "'")))
+    return clauses
+
+# Full-text query matching any of the words in text, quoted so FTS5 syntax is not interpreted
+def fts_query(text):
+    return " OR ".join(f'"{term}"' for term in re.findall(r"\w+", text.lower()))
+
+# Reciprocal rank fusion of ranked lists of rows: score = sum of 1 / (RRF_K + rank)
+def reciprocal_rank_fusion(rankings):
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+# Azure AI Search reports cosine similarity as 1 / (1 + cosine distance)
+def cosine_score(similarity):
+    return 1.0 / (2.0 - min(max(similarity, -1.0), 1.0))
+
+# In-process vector index. Normalized float32 vectors live in a memory-mapped
+# matrix (one row per chunk) and the other fields in a SQLite table keyed by row.
+# It implements the SearchClient methods the scripts use, so it can stand in for
+# Azure AI Search (see SEARCH_BACKEND in clients.py).
+class LocalVectorIndex:
+    def __init__(self, path, dimensions=LOCAL_INDEX_DIMENSIONS, use_ann=LOCAL_INDEX_ANN):
+        self.path = path
+        self.dimensions = dimensions
+        self.use_ann = use_ann and hnswlib is not None
+        if use_ann and hnswlib is None:
+            logger.warning("hnswlib is not installed, the local index uses exact search")
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(path, "metadata.sqlite3"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document_num TEXT, page_num TEXT, "
+            "fields TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_document ON chunks (document_num, page_num)")
+        self._conn.commit()
+        self._init_full_text()
+        self._rows = self._conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()[0]
+        self._alive = np.zeros(max(self._rows, INITIAL_CAPACITY), dtype=bool)
+        for (row,) in self._conn.execute("SELECT row FROM chunks WHERE deleted = 0"):
+            self._alive[row] = True
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._open_vectors(max(self._rows, INITIAL_CAPACITY))
+        self._ann = None
+
+    # BM25 keyword search over the chunk text through SQLite FTS5, when available
+    def _init_full_text(self):
+        try:
+            self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(chunk)")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite FTS5 is unavailable, the local index has no keyword search: {e}")
+            self.full_text = False
+            return
+        self.full_text = True
+        if self._conn.execute("SELECT COUNT(*) FROM chunks_fts").fetchone()[0] == 0:
+            # Index created before keyword search existed
+            self._conn.execute(
+                "INSERT INTO chunks_fts (rowid, chunk) "
+                "SELECT row, COALESCE(json_extract(fields, '$.chunk'), '') FROM chunks WHERE deleted = 0"
+            )
+        self._conn.commit()
+
+    def _open_vectors(self, capacity):
+        size = capacity * self.dimensions * 4
+        with open(self._vectors_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimensions))
+
+    def _ensure_capacity(self, rows):
+        capacity = self._vectors.shape[0]
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        self._vectors.flush()
+        del self._vectors
+        self._open_vectors(capacity)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+
+    def __len__(self):
+        return int(self._alive[:self._rows].sum())
+
+    # SearchClient.merge_or_upload_documents: documents need "id" and "embeddings"
+    def merge_or_upload_documents(self, documents):
+        results = []
+        with self._lock:
+            rows = dict(self._conn.execute(
+                f"SELECT id, row FROM chunks WHERE id IN ({','.join('?' * len(documents))})",
+                [document["id"] for document in documents]
+            ).fetchall()) if documents else {}
+            for document in documents:
+                vector = np.asarray(document.get("embeddings") or [], dtype=np.float32)
+                if vector.shape != (self.dimensions,):
+                    results.append(LocalIndexingResult(document["id"], False, 400,
+                                                       f"Expected {self.dimensions} dimensions, got {vector.size}"))
+                    continue
+                row = rows.get(document["id"])
+                is_new = row is None
+                if is_new:
+                    row = rows[document["id"]] = self._rows
+                    self._rows += 1
+                    self._ensure_capacity(self._rows)
+                norm = np.linalg.norm(vector)
+                self._vectors[row] = vector / norm if norm else vector
+                self._alive[row] = True
+                fields = {key: value for key, value in document.items() if key not in ("embeddings", "@search.action")}
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO chunks (row, id, document_num, page_num, fields, deleted) VALUES (?, ?, ?, ?, ?, 0)",
+                    (row, document["id"], fields.get("document_num"), fields.get("page_num"), json.dumps(fields))
+                )
+                if self.full_text:
+                    self._conn.execute("DELETE FROM chunks_fts WHERE rowid = ?", (row,))
+                    self._conn.execute("INSERT INTO chunks_fts (rowid, chunk) VALUES (?, ?)", (row, fields.get("chunk") or ""))
+                if self._ann is not None:
+                    if is_new:
+                        self._ann_add([row])
+                    else:
+                        # Replaced vectors are picked up by rebuilding the graph on the next search
+                        self._ann = None
+                results.append(LocalIndexingResult(document["id"], True, 200))
+            self._conn.commit()
+            self._vectors.flush()
+        return results
+
+    upload_documents = merge_or_upload_documents
+
+    # SearchClient.merge_documents: updates fields of existing documents, keeping their vectors
+    def merge_documents(self, documents):
+        results = []
+        with self._lock:
+            for document in documents:
+                found = self._conn.execute(
+                    "SELECT fields FROM chunks WHERE id = ? AND deleted = 0", (document["id"],)
+                ).fetchone()
+                if found is None:
+                    results.append(LocalIndexingResult(document["id"], False, 404, "Document not found"))
+                    continue
+                fields = json.loads(found[0])
+                fields.update({key: value for key, value in document.items() if key not in ("embeddings", "@search.action")})
+                self._conn.execute(
+                    "UPDATE chunks SET page_num = ?, fields = ? WHERE id = ?",
+                    (fields.get("page_num"), json.dumps(fields), document["id"])
+                )
+                results.append(LocalIndexingResult(document["id"], True, 200))
+            self._conn.commit()
+        return results
+
+    def delete_documents(self, documents):
+        ids = [document["id"] for document in documents]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT row FROM chunks WHERE id IN ({','.join('?' * len(ids))})", ids
+            ).fetchall() if ids else []
+            for (row,) in rows:
+                if self._ann is not None and self._alive[row]:
+                    self._ann.mark_deleted(row)
+                self._alive[row] = False
+                if self.full_text:
+                    self._conn.execute("DELETE FROM chunks_fts WHERE rowid = ?", (row,))
+            self._conn.executemany("UPDATE chunks SET deleted = 1 WHERE id = ?", [(id,) for id in ids])
+            self._conn.commit()
+        return [LocalIndexingResult(id, True, 200) for id in ids]
+
+    # Rows matching the parsed filter clauses, found through the SQLite metadata table
+    def _filter_rows(self, clauses):
+        where = " AND ".join(f"{field} = ?" for field, _ in clauses)
+        rows = self._conn.execute(
+            f"SELECT row FROM chunks WHERE deleted = 0 AND {where}", [value for _, value in clauses]
+        ).fetchall()
+        return np.array([row for (row,) in rows], dtype=np.int64)
+
+    # Rows ranked by BM25 for search_text, restricted by the filter clauses in the same query
+    def _keyword_rows(self, search_text, clauses, limit):
+        match = fts_query(search_text)
+        if not self.full_text or not match:
+            return []
+        where = "".join(f" AND c.{field} = ?" for field, _ in clauses)
+        rows = self._conn.execute(
+            "SELECT f.rowid, bm25(chunks_fts) FROM chunks_fts f JOIN chunks c ON c.row = f.rowid "
+            f"WHERE chunks_fts MATCH ? AND c.deleted = 0{where} ORDER BY bm25(chunks_fts) LIMIT ?",
+            [match] + [value for _, value in clauses] + [limit]
+        ).fetchall()
+        # bm25() is lower for better matches
+        return [(row, -score) for row, score in rows]
+
+    def _fields(self, rows):
+        if len(rows) == 0:
+            return {}
+        placeholders = ",".join("?" * len(rows))
+        return {row: json.loads(fields) for row, fields in self._conn.execute(
+            f"SELECT row, fields FROM chunks WHERE row IN ({placeholders})", [int(row) for row in rows]
+        )}
+
+    def _build_ann(self):
+        self._ann = hnswlib.Index(space="cosine", dim=self.dimensions)
+        self._ann.init_index(max_elements=max(self._vectors.shape[0], 1), ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        self._ann.set_ef(HNSW_EF_SEARCH)
+        self._ann_add(np.flatnonzero(self._alive[:self._rows]))
+
+    def _ann_add(self, rows):
+        if len(rows) == 0:
+            return
+        if self._ann.get_max_elements() < self._vectors.shape[0]:
+            self._ann.resize_index(self._vectors.shape[0])
+        self._ann.add_items(self._vectors[rows], np.asarray(rows))
+
+    # Top-k (row, cosine similarity) pairs. Exact search is one vectorized
+    # matrix-vector product over the candidate rows.
+    def nearest(self, vector, k, candidate_rows=None):
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        with self._lock:
+            if candidate_rows is None and self.use_ann:
+                if self._ann is None:
+                    self._build_ann()
+                count = min(k, len(self))
+                if count == 0:
+                    return []
+                labels, distances = self._ann.knn_query(query, k=count)
+                return [(int(row), 1.0 - float(distance)) for row, distance in zip(labels[0], distances[0])]
+            if candidate_rows is None:
+                candidate_rows = np.flatnonzero(self._alive[:self._rows])
+            if len(candidate_rows) == 0:
+                return []
+            scores = self._vectors[candidate_rows] @ query
+            k = min(k, len(candidate_rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(candidate_rows[i]), float(scores[i])) for i in top]
+
+    # SearchClient.search with filter pushdown. search_text alone is a BM25 keyword
+    # search ("*" lists every match of the filter), a vector query alone is a
+    # nearest-neighbour search, and both together are fused with reciprocal rank
+    # fusion like an Azure AI Search hybrid query. Results are dicts of the selected
+    # fields plus "@search.score".
+    def search(self, search_text=None, vector_queries=None, select=None, top=None, filter=None, **kwargs):
+        with self._lock:
+            clauses = parse_filter(filter) if filter else []
+            candidate_rows = self._filter_rows(clauses) if clauses else None
+            keyword = search_text not in (None, "", "*")
+            vector_ranked = []
+            if vector_queries:
+                vector_query = vector_queries[0]
+                k = vector_query.k_nearest_neighbors or DEFAULT_KEYWORD_CANDIDATES
+                vector_ranked = self.nearest(vector_query.vector, k, candidate_rows)
+            keyword_ranked = []
+            if keyword:
+                keyword_ranked = self._keyword_rows(search_text, clauses, max(top or DEFAULT_KEYWORD_CANDIDATES, len(vector_ranked)))
+            if vector_queries and keyword:
+                ranked = reciprocal_rank_fusion([[row for row, _ in vector_ranked], [row for row, _ in keyword_ranked]])
+            elif vector_queries:
+                ranked = [(row, cosine_score(similarity)) for row, similarity in vector_ranked]
+            elif keyword:
+                ranked = keyword_ranked
+            else:
+                if candidate_rows is None:
+                    candidate_rows = np.flatnonzero(self._alive[:self._rows])
+                ranked = [(int(row), 1.0) for row in candidate_rows]
+            if top is not None:
+                ranked = ranked[:top]
+        fields = self._fields([row for row, _ in ranked])
+        results = []
+        for row, score in ranked:
+            document = fields[row]
+            if select:
+                document = {key: document.get(key) for key in select}
+            document["@search.score"] = score
+            results.append(document)
+        return results
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+# Shared local index per index name, stored under LOCAL_INDEX_PATH
+def get_local_index(index_name=None):
+    index_name = index_name or os.getenv("AZURE_AISEARCH_INDEX") or "default"
+    with _indexes_lock:
+        index = _indexes.get(index_name)
+        if index is None:
+            index = _indexes[index_name] = LocalVectorIndex(os.path.join(LOCAL_INDEX_PATH, index_name))
+        return index
@@ -0,0 +1,95 @@
+import os
+import atexit
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+# Worker processes used for extraction (1 keeps the serial path) and pages per task
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", "1"))
+PDF_EXTRACT_PAGES_PER_TASK = int(os.getenv("PDF_EXTRACT_PAGES_PER_TASK", "16"))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_page_count(pdf_path):
+    with fitz.open(pdf_path) as pdf_document:
+        return len(pdf_document)
+
+# Function to stream text from a PDF one page at a time
+def iter_pdf_pages(pdf_path):
+    try:
+        with fitz.open(pdf_path) as pdf_document:
+            logger.info(f"PDF has {len(pdf_document)} pages")
+            for page_num in range(len(pdf_document)):
+                page = pdf_document.load_page(page_num)
+                yield page_num, page.get_text()
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF: {str(e)}")
+        raise
+
+# Worker: opens its own PyMuPDF document and extracts pages [start, stop)
+def extract_page_range(pdf_path, start, stop):
+    with fitz.open(pdf_path) as pdf_document:
+        return [(page_num, pdf_document.load_page(page_num).get_text()) for page_num in range(start, stop)]
+
+def page_ranges(page_count, pages_per_task):
+    return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+# Function to get the process pool with the given number of workers. Pools are created
+# on first use and kept until exit, so the cost of starting the workers (and importing
+# PyMuPDF in each) is paid once per process rather than once per file.
+# Workers are spawned, not forked: the pool is created from pipeline threads, and
+# forking a multi-threaded process can deadlock the child on a copied lock.
+def get_extract_pool(workers):
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return pool
+
+@atexit.register
+def shutdown_extract_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(cancel_futures=True)
+
+# Runs fn over the argument tuples in the shared process pool and yields results in
+# submission order. At most 2 tasks per worker are outstanding, so results are
+# not buffered without bound when the consumer is slower than extraction.
+def _ordered_map(fn, task_args, workers):
+    executor = get_extract_pool(workers)
+    pending = deque()
+    try:
+        for args in task_args:
+            pending.append(executor.submit(fn, *args))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Tasks of an abandoned or failed extraction must not hold up the next file
+        for future in pending:
+            future.cancel()
+
+# Function to stream text from a PDF with page ranges extracted in parallel by
+# worker processes. Pages are yielded in order with their original page numbers.
+def iter_pdf_pages_parallel(pdf_path, workers=PDF_EXTRACT_WORKERS, pages_per_task=PDF_EXTRACT_PAGES_PER_TASK):
+    if workers <= 1:
+        yield from iter_pdf_pages(pdf_path)
+        return
+    try:
+        page_count = get_page_count(pdf_path)
+        logger.info(f"PDF has {page_count} pages, extracting with {workers} processes")
+        task_args = [(pdf_path, start, stop) for start, stop in page_ranges(page_count, pages_per_task)]
+        for pages in _ordered_map(extract_page_range, task_args, workers):
+            yield from pages
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF: {str(e)}")
+        raise
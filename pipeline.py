@@ -0,0 +1,111 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_QUEUE_SIZE = 8
+
+_DONE = object()
+
+# Carries a stage's exception downstream to the consumer
+class _StageError(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+# Put that gives up once the pipeline has been stopped, so a stage blocked on a
+# full queue does not hang after the consumer goes away
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+# Input of a stage: gets that likewise end once the pipeline has been stopped, so a
+# stage waiting on an upstream that died or was abandoned does not block forever
+class _QueueReader:
+    def __init__(self, q, stop):
+        self.q = q
+        self.stop = stop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                item = self.q.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise StopIteration
+                continue
+            if item is _DONE:
+                raise StopIteration
+            if isinstance(item, _StageError):
+                raise item
+            return item
+
+    # True when no item is waiting, i.e. the next one would block on the upstream stage
+    def idle(self):
+        return self.q.empty()
+
+def _run_stage(name, stage, items, out, stop):
+    try:
+        for item in stage(items):
+            if not _put(out, item, stop):
+                return
+        _put(out, _DONE, stop)
+    except _StageError as e:
+        _put(out, e, stop)
+    except BaseException as e:
+        logger.error(f"Pipeline stage {name} failed: {e}")
+        _put(out, _StageError(e), stop)
+
+# Runs source -> stage -> stage -> ... with each stage in its own thread, connected
+# by bounded queues. A stage is a function that takes an iterator and yields items.
+# At most queue_size items wait between two stages, so memory stays flat however
+# large the source is, and downstream stages start as soon as the first items are
+# produced. Yields the output of the last stage; an error in any stage is re-raised.
+def run_pipeline(source, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    if not stages:
+        yield from source
+        return
+    stop = threading.Event()
+    threads = []
+    previous = None
+    for stage in stages:
+        out = queue.Queue(maxsize=queue_size)
+        # The source itself is consumed by the first stage's thread
+        stage_input = iter(source) if previous is None else _QueueReader(previous, stop)
+        name = getattr(stage, "__name__", repr(stage))
+        thread = threading.Thread(target=_run_stage, args=(name, stage, stage_input, out, stop), daemon=True)
+        threads.append(thread)
+        previous = out
+    for thread in threads:
+        thread.start()
+    try:
+        yield from _QueueReader(previous, stop)
+    except _StageError as e:
+        raise e.error
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=1)
+
+# Helper for stages that work on groups: yields lists of up to size items. Inside a
+# pipeline a partial group is yielded as soon as the upstream stage has nothing more
+# waiting, so the stage starts work instead of waiting for a full group.
+def batched(items, size):
+    idle = getattr(items, "idle", None)
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size or (idle is not None and idle()):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
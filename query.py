@@ -1,12 +1,16 @@
 import os
+import json
 import logging
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 import random
 import requests
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
+from clients import HTTP_TIMEOUT, get_search_client, get_session
+from context import build_context
+from query_cache import get_answer_cache, get_query_embedding
+from telemetry import add_counter, observe_seconds, record_usage, span
  
 load_dotenv()
  
@@ -29,73 +33,73 @@ for var in required_vars:
         logger.error(f"Missing required environment variable: {var}")
         raise ValueError(f"Missing required environment variable: {var}")
  
-def generate_embeddings(text):
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": os.getenv("AZURE_OPENAI_KEY")
-    }
-    payload = {
-        "input": text,
-        "model": os.getenv("MODEL_EMBEDDINGS_DEPLOYMENT_NAME")
-    }
-    try:
-        response = requests.post(
-            f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('MODEL_EMBEDDINGS_DEPLOYMENT_NAME')}/embeddings?api-version=2023-05-15",
-            headers=headers,
-            json=payload
-        )
-        print(response.json())
-        response.raise_for_status()
-        return response.json()['data'][0]['embedding']
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error generating embeddings: {e.response.text}")
-        raise
+# Nearest neighbours taken from the vector query, results returned, and the default
+# search type ('vector' or 'hybrid', which adds a keyword query on the same text)
+SEARCH_K = int(os.getenv("SEARCH_K", "3"))
+SEARCH_TOP = int(os.getenv("SEARCH_TOP", "5"))
+SEARCH_TYPE = os.getenv("SEARCH_TYPE", "vector").lower()
+# Candidates rescored per requested neighbour when the index compresses vectors
+# (AZURE_VECTOR_COMPRESSION in create.py); overrides the index default
+VECTOR_OVERSAMPLING = float(os.getenv("AZURE_VECTOR_OVERSAMPLING")) if os.getenv("AZURE_VECTOR_OVERSAMPLING") else None
+VECTOR_COMPRESSED = os.getenv("AZURE_VECTOR_COMPRESSION", "none").lower() != "none"
+SELECT_FIELDS = ["document_num", "page_num", "chunk_num", "chunk_begin", "chunk_end", "chunk", "url"]
  
-def query_azure_search(query, search_type='vector'):
+# Function to search the index. filter is an OData filter (see indexing.build_filter)
+# applied by the search service before ranking, so only matching chunks are scored.
+def query_azure_search(query, search_type=None, query_embedding=None, filter=None, k=None, top=None):
+    search_type = search_type or SEARCH_TYPE
+    k = k or SEARCH_K
+    top = top or SEARCH_TOP
     try:
-        credential = AzureKeyCredential(os.getenv("AZURE_AISEARCH_KEY"))
-        search_client = SearchClient(endpoint=os.getenv("AZURE_AISEARCH_ENDPOINT"),
-                                     index_name=os.getenv("AZURE_AISEARCH_INDEX"),
-                                     credential=credential)
+        search_client = get_search_client()
         v_query = VectorizedQuery(
-            vector=generate_embeddings(query),
-            k_nearest_neighbors=3,
-            fields="embeddings"
+            vector=query_embedding if query_embedding is not None else get_query_embedding(query),
+            k_nearest_neighbors=k,
+            fields="embeddings",
+            oversampling=VECTOR_OVERSAMPLING if VECTOR_COMPRESSED else None
         )
-        print(v_query)
-        if search_type == 'vector':
-            results = search_client.search(
-                search_text=None,
-                vector_queries=[v_query],
-                select=["document_num", "page_num", "chunk_num", "chunk_begin", "chunk_end", "chunk", "url"],
-                top=20
-            )
-        # elif search_type == 'hybrid':
-        #     results = search_client.search(
-        #         search_text=query,
-        #         vector_queries=[v_query],
-        #         select=["chunk_id", "parent_id", "chunk", "title"],
-        #         top=20
-        #     )
-        else:
-            raise ValueError("Invalid search type. Use 'vector' or 'hybrid'.")
+        with span("search", search_type=search_type) as s:
+            if search_type == 'vector':
+                results = search_client.search(
+                    search_text=None,
+                    vector_queries=[v_query],
+                    filter=filter,
+                    select=SELECT_FIELDS,
+                    top=min(k, top)
+                )
+            elif search_type == 'hybrid':
+                # Keyword and vector rankings are merged with reciprocal rank fusion
+                results = search_client.search(
+                    search_text=query,
+                    vector_queries=[v_query],
+                    filter=filter,
+                    select=SELECT_FIELDS,
+                    top=top
+                )
+            else:
+                raise ValueError("Invalid search type. Use 'vector' or 'hybrid'.")
+            results = list(results)
+            s.add_items(len(results))
        
-        return list(results)
+        return results
     except Exception as e:
         logger.error(f"Error querying Azure Search: {str(e)}")
         return []
  
-def query_azure_openai(prompt, search_results):
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": os.getenv("AZURE_OPENAI_KEY")
-    }
-    content = " ".join([result['chunk'] for result in search_results])
+# Stream chat completions token by token instead of waiting for the full answer
+CHAT_STREAM = os.getenv("CHAT_STREAM", "true").lower() == "true"
+ 
+def chat_completions_url():
+    return f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('MODEL_CHAT_DEPLOYMENT_NAME')}/chat/completions?api-version=2023-05-15"
+ 
+def build_chat_payload(prompt, search_results):
+    content, used_results = build_context(search_results)
+    logger.info(f"Prompt context uses {len(used_results)} of {len(search_results)} search results")
    
-    payload = {
+    return {
         "messages": [
             {"role": "system", "content": f"""{os.getenv("SYSTEM_MESSAGE")}"""},
-            {"role": "user", "content": f"Based on the following search results, please answer this question: {prompt}\n\nSearch Results: {content[:4000]}"}
+            {"role": "user", "content": f"Based on the following search results, please answer this question: {prompt}\n\nSearch Results:\n{content}"}
         ],
         "max_tokens": 1000,
         "temperature": 0.3,
@@ -104,18 +108,61 @@ def query_azure_openai(prompt, search_results):
         "top_p": 0.90,
         "stop": None
     }
+ 
+def query_azure_openai(prompt, search_results):
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv("AZURE_OPENAI_KEY")
+    }
+    payload = build_chat_payload(prompt, search_results)
     try:
-        response = requests.post(
-            f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('MODEL_CHAT_DEPLOYMENT_NAME')}/chat/completions?api-version=2023-05-15",
-            headers=headers,
-            json=payload
-        )
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
+        with span("chat"):
+            response = get_session().post(
+                chat_completions_url(),
+                headers=headers,
+                json=payload,
+                timeout=HTTP_TIMEOUT
+            )
+            response.raise_for_status()
+            result = response.json()
+        record_usage("chat", result.get("usage"))
+        return result['choices'][0]['message']['content']
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error querying Azure OpenAI: {e.response.text}")
+        logger.error(f"Error querying Azure OpenAI: {e.response.text if e.response is not None else e}")
         return None
  
+# Function to stream a chat completion. Yields pieces of the answer as the SSE
+# stream delivers them; timings (if given) gets first_token_ms and total_ms.
+def query_azure_openai_stream(prompt, search_results, timings=None):
+    headers = {
+        "Content-Type": "application/json",
+        "api-key": os.getenv("AZURE_OPENAI_KEY")
+    }
+    payload = build_chat_payload(prompt, search_results)
+    payload["stream"] = True
+    timings = timings if timings is not None else {}
+    start = time.perf_counter()
+    with span("chat", stream=True), get_session().post(chat_completions_url(), headers=headers, json=payload,
+                                                        timeout=HTTP_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            # Only sent by API versions that support stream_options.include_usage
+            record_usage("chat", event.get("usage"))
+            choices = event.get("choices") or []
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if delta:
+                if "first_token_ms" not in timings:
+                    timings["first_token_ms"] = (time.perf_counter() - start) * 1000
+                    observe_seconds("chat_first_token_seconds", timings["first_token_ms"] / 1000)
+                yield delta
+    timings["total_ms"] = (time.perf_counter() - start) * 1000
+ 
 def save_to_markdown(query, vector_results, hybrid_results, answer, filename="output.md"):
     try:
         random_suffix = random.randint(1000, 9999)
@@ -149,6 +196,43 @@ def save_to_markdown(query, vector_results, hybrid_results, answer, filename="ou
     except Exception as e:
         logger.error(f"Error saving to markdown: {str(e)}")
  
+# Function to answer a question end to end: answer cache, search, chat completion.
+# With on_token the completion is streamed and each piece is passed to it as it arrives.
+# Filtered questions bypass the answer cache, whose entries are not scoped by filter.
+# Returns (answer, search results, cached).
+def answer_question(query, on_token=None, timings=None, search_type=None, filter=None):
+    try:
+        query_embedding = get_query_embedding(query)
+    except Exception as e:
+        # Reported like a failed search: no results and no answer
+        logger.error(f"Error generating query embedding: {str(e)}")
+        return None, [], False
+    answer_cache = get_answer_cache() if filter is None else None
+    cached_answer = answer_cache.lookup(query_embedding) if answer_cache else None
+    if cached_answer:
+        add_counter("answer_cache_hits_total")
+        if on_token:
+            on_token(cached_answer)
+        return cached_answer, [], True
+    vector_results = query_azure_search(query, search_type, query_embedding, filter)
+    if not vector_results:
+        return None, [], False
+    if on_token:
+        try:
+            pieces = []
+            for piece in query_azure_openai_stream(query, vector_results, timings):
+                pieces.append(piece)
+                on_token(piece)
+            answer = "".join(pieces) or None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error querying Azure OpenAI: {e.response.text if e.response is not None else e}")
+            answer = None
+    else:
+        answer = query_azure_openai(query, vector_results)
+    if answer and answer_cache:
+        answer_cache.store(query, query_embedding, answer)
+    return answer, vector_results, False
+ 
 def main():
     logger.info("Starting query script execution.")
     print("Ready to accept your question.")
@@ -156,41 +240,33 @@ def main():
     print("", flush=True)
    
     if query:
-        vector_results = query_azure_search(query, 'vector')
-        #hybrid_results = query_azure_search(query, 'hybrid')
-        # if vector_results:
-        #     print("Vector Search Results:")
-        #     for result in vector_results:
-        #         print(f"Doc Num: {result['document_num']}")
-        #         print(f"Page Num: {result['page_num']}")
-        #         print(f"Chunk Num: {result['chunk_num']}")
-        #         print(f"Chunk Begin: {result['chunk_begin']}")
-        #         print(f"Chunk End: {result['chunk_end']}")
-        #         print(f"Chunk: {result['chunk'][:100]}...\n")
-        #         print(f"Score: {result['@search.score']}")
-       
-        # if vector_results:
-        #     print("\nHybrid Search Results:")
-        #     for result in hybrid_results:
-        #         print(f"Title: {result['title']}")
-        #         print(f"Chunk ID: {result['chunk_id']}")
-        #         print(f"Parent ID: {result['parent_id']}")
-        #         print(f"Score: {result['@search.score']}")
-        #         print(f"Content: {result['chunk'][:100]}...\n")
-       
-        # combined_results = vector_results + hybrid_results
-       
-        if vector_results:
-            #answer = query_azure_openai(query, combined_results)
-            answer = query_azure_openai(query, vector_results)
-            if answer:
+        timings = {}
+        streamed = []
+        def print_piece(piece):
+            if not streamed:
+                print("Answer:")
+            streamed.append(piece)
+            print(piece, end="", flush=True)
+        answer, vector_results, cached = answer_question(query, print_piece if CHAT_STREAM else None, timings)
+        if streamed:
+            print()
+        if cached:
+            if not streamed:
+                print("Answer (cached):")
+                print(answer)
+            logger.info("Answer served from cache.")
+        elif not vector_results:
+            print("No search results found. Please check your index and query.")
+        elif answer:
+            if not streamed:
                 print("Answer:")
                 print(answer)
-                save_to_markdown(query, vector_results, vector_results, answer)
             else:
-                logger.error("Failed to get a response from Azure OpenAI.")
+                logger.info(f"Time to first token: {timings.get('first_token_ms', 0):.0f} ms, "
+                            f"total: {timings.get('total_ms', 0):.0f} ms")
+            save_to_markdown(query, vector_results, vector_results, answer)
         else:
-            print("No search results found. Please check your index and query.")
+            logger.error("Failed to get a response from Azure OpenAI.")
     else:
         logger.warning("No query specified.")
  
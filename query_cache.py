@@ -0,0 +1,192 @@
+import os
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from embedding_cache import normalize_text
+from embeddings import generate_embeddings
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Level 1: query embeddings, in memory in front of the on-disk embedding cache
+QUERY_EMBEDDING_LRU_SIZE = int(os.getenv("QUERY_EMBEDDING_LRU_SIZE", "1024"))
+
+# Level 2: answers reused when a new query embedding is within the cosine threshold
+# of a cached query for the same index version
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", ".cache/answers.sqlite3")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+# Change this whenever the index content changes so stale answers are not served
+INDEX_VERSION = os.getenv("AZURE_AISEARCH_INDEX_VERSION") or os.getenv("AZURE_AISEARCH_INDEX", "")
+
+class EmbeddingLRU:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+query_embeddings = EmbeddingLRU(QUERY_EMBEDDING_LRU_SIZE)
+
+# Function to embed a user query, served from memory for repeated questions
+def get_query_embedding(query):
+    key = normalize_text(query).lower()
+    embedding = query_embeddings.get(key)
+    if embedding is None:
+        embedding = generate_embeddings(query)
+        query_embeddings.put(key, embedding)
+    return embedding
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Semantic answer cache. Entries for the current index version are held in memory
+# as rows of a normalized float32 matrix so a lookup is a single matrix-vector product;
+# SQLite keeps them across runs. Entries expire after ttl_seconds and the least
+# recently used are evicted beyond max_entries. Storing an answer writes one row into
+# a free slot of the matrix rather than reloading it.
+class AnswerCache:
+    def __init__(self, path, index_version, threshold, ttl_seconds, max_entries):
+        self.index_version = index_version
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, index_version TEXT NOT NULL, query TEXT NOT NULL, "
+            "embedding BLOB NOT NULL, answer TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_version ON answers (index_version, last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._conn.commit()
+        self._total = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        rows = self._conn.execute(
+            "SELECT id, embedding, answer, created_at FROM answers WHERE index_version = ?", (self.index_version,)
+        ).fetchall()
+        self._matrix = None
+        self._ids = []
+        self._answers = []
+        self._created = np.zeros(0)
+        self._alive = np.zeros(0, dtype=bool)
+        self._slots = {}
+        self._free = []
+        for id, embedding, answer, created_at in rows:
+            self._put_slot(id, np.frombuffer(embedding, dtype=np.float32), answer, created_at)
+
+    # Writes an entry into a free slot, growing the arrays by doubling when full
+    def _put_slot(self, id, vector, answer, created_at):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._ids)
+            if slot >= self._created.size:
+                capacity = max(16, slot * 2)
+                matrix = np.zeros((capacity, vector.size), dtype=np.float32)
+                created = np.zeros(capacity)
+                alive = np.zeros(capacity, dtype=bool)
+                if slot:
+                    matrix[:slot] = self._matrix[:slot]
+                    created[:slot] = self._created[:slot]
+                    alive[:slot] = self._alive[:slot]
+                self._matrix, self._created, self._alive = matrix, created, alive
+            self._ids.append(None)
+            self._answers.append(None)
+        self._matrix[slot] = vector
+        self._ids[slot] = id
+        self._answers[slot] = answer
+        self._created[slot] = created_at
+        self._alive[slot] = True
+        self._slots[id] = slot
+
+    def _drop_slot(self, id):
+        slot = self._slots.pop(id, None)
+        if slot is not None:
+            self._alive[slot] = False
+            self._answers[slot] = None
+            self._free.append(slot)
+
+    # Returns the cached answer for the closest earlier query, or None
+    def lookup(self, embedding):
+        with self._lock:
+            if not self._slots:
+                return None
+            used = len(self._ids)
+            scores = self._matrix[:used] @ _unit(embedding)
+            # Free slots and expired entries never match
+            valid = self._alive[:used] & (self._created[:used] >= time.time() - self.ttl_seconds)
+            scores = np.where(valid, scores, -np.inf)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self._conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), self._ids[best]))
+            self._conn.commit()
+            logger.info(f"Answer cache hit (similarity {scores[best]:.3f})")
+            return self._answers[best]
+
+    def store(self, query, embedding, answer):
+        vector = _unit(embedding)
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO answers (index_version, query, embedding, answer, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.index_version, query, vector.tobytes(), answer, now, now)
+            )
+            self._put_slot(cursor.lastrowid, vector, answer, now)
+            self._total += 1
+            if self._total > self.max_entries:
+                evicted = [id for (id,) in self._conn.execute(
+                    "SELECT id FROM answers ORDER BY last_used LIMIT ?", (self._total - self.max_entries,)
+                )]
+                self._conn.executemany("DELETE FROM answers WHERE id = ?", [(id,) for id in evicted])
+                self._total -= len(evicted)
+                for id in evicted:
+                    self._drop_slot(id)
+            self._conn.commit()
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+# Shared answer cache for the current index version, or None when disabled
+def get_answer_cache():
+    global _answer_cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(ANSWER_CACHE_PATH, INDEX_VERSION, ANSWER_CACHE_THRESHOLD,
+                                        ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES)
+        return _answer_cache
@@ -0,0 +1,198 @@
+import os
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from flask import Flask, Response, jsonify, request
+from dotenv import load_dotenv
+# Importing query validates the environment and loads the SDKs once per process
+from indexing import build_filter
+from query import answer_question
+from telemetry import render_prometheus
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Questions answered at the same time, questions allowed to wait for a slot, and
+# how long they may wait before the service sheds load with a 503
+QUERY_SERVICE_MAX_CONCURRENCY = int(os.getenv("QUERY_SERVICE_MAX_CONCURRENCY", "16"))
+QUERY_SERVICE_MAX_QUEUE = int(os.getenv("QUERY_SERVICE_MAX_QUEUE", "64"))
+QUERY_SERVICE_QUEUE_TIMEOUT = float(os.getenv("QUERY_SERVICE_QUEUE_TIMEOUT", "10"))
+QUERY_SERVICE_HOST = os.getenv("QUERY_SERVICE_HOST", "127.0.0.1")
+QUERY_SERVICE_PORT = int(os.getenv("QUERY_SERVICE_PORT", "8000"))
+LATENCY_WINDOW_SIZE = 10000
+
+app = Flask(__name__)
+
+# Admission control: at most QUERY_SERVICE_MAX_CONCURRENCY questions run, at most
+# QUERY_SERVICE_MAX_QUEUE more wait; anything beyond that is rejected immediately
+class AdmissionControl:
+    def __init__(self, max_concurrency, max_queue, queue_timeout):
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self.max_admitted = max_concurrency + max_queue
+        self.queue_timeout = queue_timeout
+        self.rejected = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._admitted >= self.max_admitted:
+                self.rejected += 1
+                return False
+            self._admitted += 1
+        if self._slots.acquire(timeout=self.queue_timeout):
+            return True
+        with self._lock:
+            self._admitted -= 1
+            self.rejected += 1
+        return False
+
+    def release(self):
+        self._slots.release()
+        with self._lock:
+            self._admitted -= 1
+
+    def in_flight(self):
+        with self._lock:
+            return self._admitted
+
+# Latencies of the most recent requests, for percentile reporting
+class LatencyWindow:
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, latency_ms):
+        with self._lock:
+            self._latencies.append(latency_ms)
+            self.count += 1
+
+    def percentiles(self, points=(50, 95, 99)):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return {}
+        # Nearest-rank percentile
+        return {f"p{p}": latencies[max(0, -(-p * len(latencies) // 100) - 1)] for p in points}
+
+admission = AdmissionControl(QUERY_SERVICE_MAX_CONCURRENCY, QUERY_SERVICE_MAX_QUEUE, QUERY_SERVICE_QUEUE_TIMEOUT)
+latencies = LatencyWindow(LATENCY_WINDOW_SIZE)
+first_token_latencies = LatencyWindow(LATENCY_WINDOW_SIZE)
+
+def source_of(result):
+    return {key: result.get(key) for key in ["document_num", "page_num", "chunk_num", "url", "@search.score"]}
+
+def sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+# Server-sent events for a streamed answer: {"delta": ...} per piece, then a final
+# event with sources and timings.
+def stream_answer(question, search_type=None, filter=None):
+    pieces = queue.Queue()
+    done = object()
+    outcome = {}
+    timings = {}
+    start = time.perf_counter()
+
+    def run():
+        try:
+            outcome["result"] = answer_question(question, pieces.put, timings, search_type, filter)
+        except Exception as e:
+            logger.error(f"Error answering question: {str(e)}")
+        finally:
+            pieces.put(done)
+
+    worker = threading.Thread(target=run, daemon=True)
+    try:
+        worker.start()
+        first_token_ms = None
+        while True:
+            piece = pieces.get()
+            if piece is done:
+                break
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - start) * 1000
+                first_token_latencies.record(first_token_ms)
+            yield sse({"delta": piece})
+        latency_ms = (time.perf_counter() - start) * 1000
+        latencies.record(latency_ms)
+        answer, results, cached = outcome.get("result", (None, [], False))
+        if not answer:
+            yield sse({"error": "No answer found", "latency_ms": latency_ms})
+            return
+        yield sse({
+            "done": True,
+            "cached": cached,
+            "sources": [source_of(result) for result in results],
+            "first_token_ms": first_token_ms,
+            "latency_ms": latency_ms
+        })
+    finally:
+        worker.join()
+
+@app.route('/ask', methods=['POST'])
+def ask():
+    body = request.get_json(silent=True) or {}
+    question = (body.get("question") or "").strip()
+    if not question:
+        return jsonify({"error": "Missing 'question'"}), 400
+    search_type = body.get("search_type")
+    if search_type not in (None, "vector", "hybrid"):
+        return jsonify({"error": "Invalid 'search_type', use 'vector' or 'hybrid'"}), 400
+    filter = build_filter(body.get("document_num"), body.get("page_num"))
+    if not admission.acquire():
+        response = jsonify({"error": "Service is at capacity, retry later"})
+        response.headers["Retry-After"] = "1"
+        return response, 503
+    if body.get("stream"):
+        response = Response(stream_answer(question, search_type, filter), mimetype="text/event-stream")
+        # Hold the admission slot until the stream has been sent or abandoned
+        response.call_on_close(admission.release)
+        return response
+    start = time.perf_counter()
+    try:
+        answer, results, cached = answer_question(question, search_type=search_type, filter=filter)
+    except Exception as e:
+        logger.error(f"Error answering question: {str(e)}")
+        return jsonify({"error": "Failed to answer question"}), 500
+    finally:
+        admission.release()
+    latency_ms = (time.perf_counter() - start) * 1000
+    latencies.record(latency_ms)
+    if not answer:
+        return jsonify({"error": "No answer found", "latency_ms": latency_ms}), 404
+    return jsonify({
+        "answer": answer,
+        "cached": cached,
+        "sources": [source_of(result) for result in results],
+        "latency_ms": latency_ms
+    })
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({"status": "ok"})
+
+# Prometheus text format; empty unless TELEMETRY_ENABLED is set
+@app.route('/metrics')
+def metrics():
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        "requests": latencies.count,
+        "in_flight": admission.in_flight(),
+        "rejected": admission.rejected,
+        "latency_ms": latencies.percentiles(),
+        "first_token_ms": first_token_latencies.percentiles()
+    })
+
+if __name__ == '__main__':
+    logger.info(f"Query service listening on {QUERY_SERVICE_HOST}:{QUERY_SERVICE_PORT}")
+    app.run(host=QUERY_SERVICE_HOST, port=QUERY_SERVICE_PORT, threaded=True)
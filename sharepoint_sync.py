@@ -0,0 +1,258 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+import requests
+from dotenv import load_dotenv
+from clients import HTTP_TIMEOUT, get_session
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Where synced files and the sync state (change token, ETag per file) are kept
+SHAREPOINT_SYNC_DIR = os.getenv("SHAREPOINT_SYNC_DIR", ".cache/sharepoint")
+SHAREPOINT_SYNC_STATE = os.getenv("SHAREPOINT_SYNC_STATE", ".cache/sharepoint_sync.json")
+# Files downloaded at the same time
+SHAREPOINT_SYNC_CONCURRENCY = int(os.getenv("SHAREPOINT_SYNC_CONCURRENCY", "4"))
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+# GetChanges returns at most this many changes per call
+CHANGES_PAGE_SIZE = 1000
+CHANGE_TYPE_DELETE = 3
+FILE_SELECT = "$select=Name,ServerRelativeUrl,ETag,ListItemAllFields/Id&$expand=ListItemAllFields"
+
+def sp_headers(token, **extra):
+    return {"Authorization": f"Bearer {token}", "Accept": "application/json;odata=verbose", **extra}
+
+def sp_quote(value):
+    return quote(value.replace("'", "''"))
+
+def _results(payload):
+    data = payload.get("d", payload)
+    return data.get("results", data) if isinstance(data, dict) else data
+
+def _file_info(file):
+    item = file.get("ListItemAllFields") or {}
+    return {"url": file["ServerRelativeUrl"], "name": file["Name"], "etag": file.get("ETag"), "item_id": item.get("Id")}
+
+# Incremental sync of one SharePoint document library to a local directory. The
+# first run lists every file; later runs ask the list for the changes since the
+# stored change token, so the work done is proportional to what changed. Files are
+# downloaded with If-None-Match on their last ETag, so metadata-only changes never
+# transfer content, and are streamed to disk by concurrent workers.
+class LibrarySync:
+    def __init__(self, site_url, library_path, list_title, directory=SHAREPOINT_SYNC_DIR,
+                 state_path=SHAREPOINT_SYNC_STATE, concurrency=SHAREPOINT_SYNC_CONCURRENCY):
+        self.site_url = site_url.rstrip("/")
+        self.library_path = library_path
+        self.list_title = list_title
+        self.directory = directory
+        self.state_path = state_path
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        # Held for a whole sync so concurrent syncs cannot interleave their state changes
+        self._sync_lock = threading.RLock()
+        self.state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"change_token": None, "files": {}}
+
+    def _save_state(self):
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.state_path)
+
+    def _get(self, token, path, **kwargs):
+        response = get_session("sharepoint").get(f"{self.site_url}/_api/{path}", headers=sp_headers(token),
+                                                 timeout=HTTP_TIMEOUT, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def _list_url(self):
+        return f"web/lists/GetByTitle('{sp_quote(self.list_title)}')"
+
+    def current_change_token(self, token):
+        payload = self._get(token, f"{self._list_url()}?$select=CurrentChangeToken")
+        return payload.get("d", payload)["CurrentChangeToken"]["StringValue"]
+
+    # Every file in the library folder and its subfolders
+    def list_files(self, token, folder=None):
+        folder = folder or self.library_path
+        files = [_file_info(file) for file in _results(self._get(
+            token, f"web/GetFolderByServerRelativeUrl('{sp_quote(folder)}')/Files?{FILE_SELECT}"))]
+        for subfolder in _results(self._get(
+                token, f"web/GetFolderByServerRelativeUrl('{sp_quote(folder)}')/Folders?$select=Name,ServerRelativeUrl")):
+            if subfolder["Name"] != "Forms":
+                files.extend(self.list_files(token, subfolder["ServerRelativeUrl"]))
+        return files
+
+    # Changes since change_token: (changed item ids, deleted item ids, new change token)
+    def list_changes(self, token, change_token):
+        changed, deleted = set(), set()
+        while True:
+            query = {"query": {
+                "__metadata": {"type": "SP.ChangeQuery"},
+                "Add": True, "Update": True, "DeleteObject": True, "Rename": True, "Restore": True, "Item": True,
+                "ChangeTokenStart": {"__metadata": {"type": "SP.ChangeToken"}, "StringValue": change_token}
+            }}
+            response = get_session("sharepoint").post(
+                f"{self.site_url}/_api/{self._list_url()}/GetChanges",
+                headers=sp_headers(token, **{"Content-Type": "application/json;odata=verbose"}),
+                json=query, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            changes = _results(response.json())
+            for change in changes:
+                if change["ChangeType"] == CHANGE_TYPE_DELETE:
+                    deleted.add(change["ItemId"])
+                    changed.discard(change["ItemId"])
+                else:
+                    changed.add(change["ItemId"])
+                    deleted.discard(change["ItemId"])
+            if changes:
+                change_token = changes[-1]["ChangeToken"]["StringValue"]
+            if len(changes) < CHANGES_PAGE_SIZE:
+                return changed, deleted, change_token
+
+    # File of a list item, or None when the item is a folder or no longer exists
+    def item_file(self, token, item_id):
+        try:
+            payload = self._get(token, f"{self._list_url()}/items({int(item_id)})/File?{FILE_SELECT}")
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        file = payload.get("d", payload)
+        return _file_info(file) if file.get("ServerRelativeUrl") else None
+
+    def local_path(self, url):
+        relative = url[len(self.library_path):].lstrip("/") if url.startswith(self.library_path) else url.lstrip("/")
+        path = os.path.normpath(os.path.join(self.directory, relative))
+        if not path.startswith(os.path.normpath(self.directory) + os.sep):
+            raise ValueError(f"Refusing to write {url} outside {self.directory}")
+        return path
+
+    # Function to download a file unless its content is unchanged. Returns the local
+    # path, or None when the service answers 304 Not Modified.
+    def download(self, token, file):
+        known = self.state["files"].get(file["url"])
+        headers = sp_headers(token)
+        if known and known.get("etag") and os.path.exists(known["path"]):
+            headers["If-None-Match"] = known["etag"]
+        url = f"{self.site_url}/_api/web/GetFileByServerRelativeUrl('{sp_quote(file['url'])}')/$value"
+        with get_session("sharepoint").get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as response:
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            path = self.local_path(file["url"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + ".part"
+            with open(temp_path, "wb") as f:
+                for block in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    f.write(block)
+            os.replace(temp_path, path)
+            etag = response.headers.get("ETag") or file.get("etag")
+        with self._lock:
+            self.state["files"][file["url"]] = {"etag": etag, "path": path, "item_id": file.get("item_id")}
+        return path
+
+    # Function to have a file downloaded and handed over again on the next sync, e.g.
+    # when processing it failed after sync() returned
+    def retry_later(self, url):
+        with self._sync_lock:
+            known = self.state["files"].get(url)
+            if known is None:
+                return
+            known["etag"] = None
+            self._save_state()
+
+    # Files whose processing failed, as current file info; ones that no longer exist are None
+    def _retry_files(self, token):
+        return {url: self.item_file(token, known["item_id"])
+                for url, known in self.state["files"].items() if known.get("etag") is None and known.get("item_id")}
+
+    def _forget(self, url):
+        known = self.state["files"].pop(url, None)
+        if known and os.path.exists(known["path"]):
+            os.remove(known["path"])
+
+    # Function to bring the local copy up to date. on_changed(url, path) is called for
+    # every new or modified file and on_deleted(url) for every removed one. The change
+    # token only advances when every download succeeded, and files marked with
+    # retry_later() are fetched again, so failures are retried on the next run.
+    # Returns a summary of the run.
+    def sync(self, token, on_changed=None, on_deleted=None):
+        with self._sync_lock:
+            return self._sync(token, on_changed, on_deleted)
+
+    def _sync(self, token, on_changed, on_deleted):
+        change_token = self.state.get("change_token")
+        if change_token:
+            changed_ids, deleted_ids, next_token = self.list_changes(token, change_token)
+            by_item = {known.get("item_id"): url for url, known in self.state["files"].items()}
+            deleted_urls = [by_item[item_id] for item_id in deleted_ids if item_id in by_item]
+            candidates = [file for file in (self.item_file(token, item_id) for item_id in changed_ids) if file]
+            # Files whose processing failed last time are fetched again
+            retried = {file["url"] for file in candidates}
+            for url, file in self._retry_files(token).items():
+                if file is None:
+                    deleted_urls.append(url)
+                elif file["url"] not in retried:
+                    candidates.append(file)
+            # A changed item whose file moved out of the library is handled as a delete
+            candidates = [file for file in candidates if file["url"].startswith(self.library_path + "/")]
+        else:
+            # Take the token first so changes made during the listing are seen next time
+            next_token = self.current_change_token(token)
+            candidates = self.list_files(token)
+            listed = {file["url"] for file in candidates}
+            deleted_urls = [url for url in self.state["files"] if url not in listed]
+        # Renames show up as a change of the item; drop the entry under the old URL
+        for file in candidates:
+            for url, known in list(self.state["files"].items()):
+                if known.get("item_id") == file.get("item_id") and url != file["url"]:
+                    deleted_urls.append(url)
+
+        summary = {"listed": len(candidates), "downloaded": 0, "unchanged": 0, "deleted": 0, "failed": []}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.download, token, file): file for file in candidates}
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    path = future.result()
+                except (requests.exceptions.RequestException, OSError, ValueError) as e:
+                    logger.error(f"Failed to download {file['url']}: {e}")
+                    summary["failed"].append(file["url"])
+                    continue
+                if path is None:
+                    summary["unchanged"] += 1
+                    continue
+                summary["downloaded"] += 1
+                if on_changed:
+                    try:
+                        on_changed(file["url"], path)
+                    except Exception as e:
+                        # Forget the ETag so the file is downloaded and handed over again next time
+                        logger.error(f"Failed to process {file['url']}: {e}")
+                        summary["failed"].append(file["url"])
+                        self.state["files"][file["url"]]["etag"] = None
+        for url in set(deleted_urls):
+            self._forget(url)
+            summary["deleted"] += 1
+            if on_deleted:
+                on_deleted(url)
+        if not summary["failed"]:
+            self.state["change_token"] = next_token
+        self._save_state()
+        logger.info(f"Library sync: {summary['listed']} candidates, {summary['downloaded']} downloaded, "
+                    f"{summary['unchanged']} unchanged, {summary['deleted']} deleted, {len(summary['failed'])} failed")
+        return summary
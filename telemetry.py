@@ -0,0 +1,299 @@
+import os
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+try:
+    from opentelemetry import metrics as otel_metrics
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_metrics = None
+    otel_trace = None
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# When disabled, span() returns a shared no-op object and the counters return
+# immediately, so the instrumentation left in the hot paths costs a function call
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "false").lower() == "true"
+# "prometheus" keeps metrics in process for the text endpoint, "otel" sends spans and
+# metrics through the OpenTelemetry API (configured by the OTEL_* environment variables
+# of the installed SDK), "both" does both
+TELEMETRY_EXPORTER = os.getenv("TELEMETRY_EXPORTER", "prometheus").lower()
+# Port of a standalone /metrics endpoint for batch jobs such as ingest.py
+TELEMETRY_PROMETHEUS_PORT = os.getenv("TELEMETRY_PROMETHEUS_PORT")
+TELEMETRY_PROMETHEUS_HOST = os.getenv("TELEMETRY_PROMETHEUS_HOST", "127.0.0.1")
+METRIC_PREFIX = "policy_chatbot_"
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+# In-process counters and duration histograms, rendered in the Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{METRIC_PREFIX}{name}{_format_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{METRIC_PREFIX}{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{_format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    # Function to take the metrics recorded so far and reset them, so a worker process
+    # can hand them to the parent with each result
+    def drain(self):
+        with self._lock:
+            snapshot = {"counters": self._counters, "histograms": self._histograms}
+            self._counters = {}
+            self._histograms = {}
+        return snapshot
+
+    # Function to add the metrics drained from another registry to this one
+    def merge(self, snapshot):
+        with self._lock:
+            for key, value in snapshot["counters"].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in snapshot["histograms"].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    # Per stage: (stage, calls, busy seconds, items, errors)
+    def stage_report(self):
+        with self._lock:
+            durations = {dict(labels)["stage"]: value for (name, labels), value in self._histograms.items()
+                         if name == "stage_duration_seconds"}
+            items = {dict(labels)["stage"]: value for (name, labels), value in self._counters.items()
+                     if name == "stage_items_total"}
+            errors = {dict(labels)["stage"]: value for (name, labels), value in self._counters.items()
+                      if name == "stage_errors_total"}
+            return [(stage, histogram["count"], histogram["sum"], items.get(stage, 0), errors.get(stage, 0))
+                    for stage, histogram in sorted(durations.items())]
+
+registry = MetricsRegistry()
+
+_use_prometheus = TELEMETRY_EXPORTER in ("prometheus", "both")
+_use_otel = TELEMETRY_EXPORTER in ("otel", "both")
+if TELEMETRY_ENABLED and _use_otel and otel_trace is None:
+    logger.warning("TELEMETRY_EXPORTER requests OpenTelemetry but it is not installed, using Prometheus metrics only")
+    _use_otel = False
+    _use_prometheus = True
+_tracer = otel_trace.get_tracer(__name__) if TELEMETRY_ENABLED and _use_otel else None
+_meter = otel_metrics.get_meter(__name__) if TELEMETRY_ENABLED and _use_otel else None
+_otel_instruments = {}
+_otel_lock = threading.Lock()
+
+def _otel_instrument(name, kind):
+    with _otel_lock:
+        instrument = _otel_instruments.get(name)
+        if instrument is None:
+            if kind == "counter":
+                instrument = _meter.create_counter(METRIC_PREFIX + name)
+            else:
+                instrument = _meter.create_histogram(METRIC_PREFIX + name, unit="s")
+            _otel_instruments[name] = instrument
+        return instrument
+
+def _inc(name, value, labels):
+    if _use_prometheus:
+        registry.inc(name, value, **labels)
+    if _meter is not None:
+        _otel_instrument(name, "counter").add(value, labels)
+
+def _observe(name, seconds, labels):
+    if _use_prometheus:
+        registry.observe(name, seconds, **labels)
+    if _meter is not None:
+        _otel_instrument(name, "histogram").record(seconds, labels)
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def add_items(self, count):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+# Timed section of a stage. Records its duration in stage_duration_seconds, the items
+# it processed in stage_items_total and failures in stage_errors_total, and is an
+# OpenTelemetry span when that exporter is used.
+class Span:
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self._items = 0
+        self._otel_context = None
+        self._otel_span = None
+
+    def __enter__(self):
+        if _tracer is not None:
+            self._otel_context = _tracer.start_as_current_span(self.stage, attributes=self.attributes)
+            self._otel_span = self._otel_context.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        labels = {"stage": self.stage}
+        _observe("stage_duration_seconds", seconds, labels)
+        if self._items:
+            _inc("stage_items_total", self._items, labels)
+        if exc_type is not None:
+            _inc("stage_errors_total", 1, labels)
+        if self._otel_context is not None:
+            self._otel_context.__exit__(exc_type, exc, tb)
+        return False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+        if self._otel_span is not None:
+            self._otel_span.set_attribute(key, value)
+
+    def add_items(self, count):
+        self._items += count
+
+# Function to time a section: `with span("search", search_type="hybrid") as s: ...`
+def span(stage, **attributes):
+    if not TELEMETRY_ENABLED:
+        return _NOOP_SPAN
+    return Span(stage, attributes)
+
+def add_counter(name, value=1, **labels):
+    if TELEMETRY_ENABLED:
+        _inc(name, value, labels)
+
+def observe_seconds(name, seconds, **labels):
+    if TELEMETRY_ENABLED:
+        _observe(name, seconds, labels)
+
+# Function to count the tokens reported in the "usage" of an Azure OpenAI response
+def record_usage(operation, usage):
+    if not TELEMETRY_ENABLED or not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        if usage.get(kind):
+            _inc("tokens_total", usage[kind], {"operation": operation, "kind": kind[:-len("_tokens")]})
+
+# Function to time how long each item of an iterable takes to produce, for stages
+# that are generators such as page extraction
+def timed_iter(stage, iterable):
+    if not TELEMETRY_ENABLED:
+        return iterable
+    def timed():
+        iterator = iter(iterable)
+        labels = {"stage": stage}
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            _observe("stage_duration_seconds", time.perf_counter() - start, labels)
+            _inc("stage_items_total", 1, labels)
+            yield item
+    return timed()
+
+def render_prometheus():
+    return registry.render()
+
+# Function to hand the metrics of a worker process to its parent; None when there
+# is nothing to send
+def drain_metrics():
+    if not TELEMETRY_ENABLED or not _use_prometheus:
+        return None
+    return registry.drain()
+
+def merge_metrics(snapshot):
+    if snapshot:
+        registry.merge(snapshot)
+
+# Function to log calls, busy time and throughput per stage
+def log_stage_report(log=logger):
+    for stage, calls, seconds, items, errors in registry.stage_report():
+        rate = f", {items / seconds:.1f} items/s" if items and seconds else ""
+        log.info(f"Stage {stage}: {calls} calls, {items} items, {seconds:.2f}s busy{rate}"
+                 + (f", {errors} errors" if errors else ""))
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Function to serve /metrics on a background thread, for processes without a web app.
+# Does nothing unless telemetry is enabled and a port is given or configured.
+def start_metrics_server(port=None):
+    port = port or TELEMETRY_PROMETHEUS_PORT
+    if not TELEMETRY_ENABLED or not port:
+        return None
+    server = ThreadingHTTPServer((TELEMETRY_PROMETHEUS_HOST, int(port)), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on port {port}")
+    return server
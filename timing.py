@@ -1,90 +1,358 @@
-import requests
+import os
+import sys
+import json
+import math
+import random
+import argparse
+import threading
 import time
-import statistics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
 
 # -----------------------------
 # CONFIGURATION
 # -----------------------------
-SEARCH_SERVICE_NAME = "<your-search-service-name>"   # e.g., mysearchsvc
-INDEX_NAME = "<your-index-name>"                     # e.g., documents-index
-API_KEY = "<your-api-key>"                           # query key or admin key
-API_VERSION = "2023-07-01-Preview"
+# Usage: python timing.py <scenario> [options], see --help. Scenarios:
+#   keyword    Azure AI Search full-text query
+#   vector     Azure AI Search vector query (the query embedding is computed once up front)
+#   hybrid     Azure AI Search keyword + vector query
+#   embedding  Azure OpenAI embeddings call for the query text
+#   rag        POST /ask on query_service.py (embedding, search and chat completion)
+# Closed-loop mode keeps --concurrency requests in flight; open-loop mode starts
+# requests at --rate per second whether or not earlier ones have finished, and
+# measures latency from the scheduled start so queueing delay is not hidden.
+# --local targets bench_server.py instead of the Azure services.
+SCENARIOS = ["keyword", "vector", "hybrid", "embedding", "rag"]
+SEARCH_API_VERSION = "2023-11-01"
+EMBEDDINGS_API_VERSION = "2024-02-01"
+DEFAULT_QUERY = "test query for latency measurement"
+PERCENTILES = [50, 95, 99, 99.9]
+# Service execution time header; the name varies between "elapsed-time" and "x-ms-elapsed-time"
+SERVICE_TIME_HEADERS = ["elapsed-time", "x-ms-elapsed-time"]
 
-# Sample query for RAG-style testing
-QUERY = "test query for latency measurement"
+# Log-bucketed latency histogram: every value is counted in a bucket whose bounds
+# are within `precision` of each other, so percentiles are accurate to that relative
+# error whatever the number of samples, in constant memory
+class LatencyHistogram:
+    def __init__(self, precision=0.01, lowest_ms=0.001):
+        self.precision = precision
+        self.lowest_ms = lowest_ms
+        self._log_base = math.log1p(precision)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
 
-# Number of requests to run
-NUM_REQUESTS = 100
+    def record(self, value_ms):
+        bucket = 0 if value_ms <= self.lowest_ms else math.ceil(math.log(value_ms / self.lowest_ms) / self._log_base)
+        with self._lock:
+            self._counts[bucket] = self._counts.get(bucket, 0) + 1
+            self.count += 1
+            self.total += value_ms
+            self.min = value_ms if self.min is None else min(self.min, value_ms)
+            self.max = value_ms if self.max is None else max(self.max, value_ms)
 
-# -----------------------------
-# BUILD REQUEST
-# -----------------------------
-url = f"https://{SEARCH_SERVICE_NAME}.search.windows.net/indexes/{INDEX_NAME}/docs/search?api-version={API_VERSION}"
+    # Nearest-rank percentile, reported as the upper bound of its bucket
+    def percentile(self, p):
+        with self._lock:
+            if not self.count:
+                return None
+            rank = max(1, math.ceil(p / 100 * self.count))
+            seen = 0
+            for bucket in sorted(self._counts):
+                seen += self._counts[bucket]
+                if seen >= rank:
+                    return min(self.lowest_ms * (1 + self.precision) ** bucket, self.max)
 
-headers = {
-    "Content-Type": "application/json",
-    "api-key": API_KEY
-}
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        summary = {"count": self.count, "mean": self.total / self.count, "min": self.min, "max": self.max}
+        for p in PERCENTILES:
+            summary[f"p{p:g}"] = self.percentile(p)
+        return summary
 
-payload = {
-    "search": QUERY,
-    "top": 5
-}
+# Counters and histograms of one benchmark run, shared by all worker threads
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {"total": LatencyHistogram(), "service": LatencyHistogram(),
+                        "network": LatencyHistogram(), "first_token": LatencyHistogram()}
+        self.succeeded = 0
+        self.errors = {}
+        self.dropped = 0
+        self.cached = 0
 
-# -----------------------------
-# RUN LATENCY TEST
-# -----------------------------
-total_latencies = []
-service_latencies = []
-network_latencies = []
+    def record(self, total_ms, service_ms=None, first_token_ms=None, cached=False):
+        self.latency["total"].record(total_ms)
+        if service_ms is not None:
+            self.latency["service"].record(service_ms)
+            self.latency["network"].record(max(total_ms - service_ms, 0.0))
+        if first_token_ms is not None:
+            self.latency["first_token"].record(first_token_ms)
+        with self._lock:
+            self.succeeded += 1
+            self.cached += int(cached)
 
-print(f"Running {NUM_REQUESTS} requests...\n")
+    def error(self, kind):
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
 
-for i in range(NUM_REQUESTS):
-    start = time.time()
+def service_time(response):
+    for header in SERVICE_TIME_HEADERS:
+        if header in response.headers:
+            try:
+                return float(response.headers[header])
+            except ValueError:
+                return None
+    return None
 
-    response = requests.post(url, headers=headers, json=payload)
+def new_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    end = time.time()
-    total_latency_ms = (end - start) * 1000
+# Endpoints and keys, from .env or pointed at bench_server.py with --local
+def targets(args):
+    if args.local:
+        base = f"http://127.0.0.1:{args.local_port}"
+        return {"search_endpoint": base, "search_key": "local", "index": "bench",
+                "openai_endpoint": base, "openai_key": "local", "embeddings_deployment": "bench",
+                "service_url": base}
+    return {
+        "search_endpoint": os.getenv("AZURE_AISEARCH_ENDPOINT"),
+        "search_key": os.getenv("AZURE_AISEARCH_KEY"),
+        "index": os.getenv("AZURE_AISEARCH_INDEX"),
+        "openai_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "openai_key": os.getenv("AZURE_OPENAI_KEY"),
+        "embeddings_deployment": os.getenv("MODEL_EMBEDDINGS_DEPLOYMENT_NAME"),
+        "service_url": args.service_url
+    }
 
-    # Extract Azure Search service execution time
-    # Header name can vary: "elapsed-time" or "x-ms-elapsed-time"
-    service_time_ms = None
+def embeddings_request(target, query):
+    url = f"{target['openai_endpoint']}/openai/deployments/{target['embeddings_deployment']}/embeddings?api-version={EMBEDDINGS_API_VERSION}"
+    payload = {"input": query}
+    if os.getenv("AZURE_EMBEDDING_DIMENSIONS"):
+        payload["dimensions"] = int(os.getenv("AZURE_EMBEDDING_DIMENSIONS"))
+    return url, {"api-key": target["openai_key"]}, payload
 
-    if "elapsed-time" in response.headers:
-        service_time_ms = float(response.headers["elapsed-time"])
-    elif "x-ms-elapsed-time" in response.headers:
-        service_time_ms = float(response.headers["x-ms-elapsed-time"])
+def search_request(target, payload):
+    url = f"{target['search_endpoint']}/indexes/{target['index']}/docs/search?api-version={SEARCH_API_VERSION}"
+    return url, {"api-key": target["search_key"]}, payload
 
-    if service_time_ms is not None:
-        network_time_ms = total_latency_ms - service_time_ms
-        service_latencies.append(service_time_ms)
-        network_latencies.append(network_time_ms)
+# Function to build a callable per query that sends one request of the scenario and
+# returns (response, first_token_ms). Query embeddings for vector and hybrid search
+# are fetched here, before timing starts.
+def build_scenario(args, target, session):
+    def vector_query(embedding):
+        return {"kind": "vector", "vector": embedding, "k": args.k, "fields": "embeddings"}
 
-    total_latencies.append(total_latency_ms)
+    def embed(query):
+        url, headers, payload = embeddings_request(target, query)
+        response = session.post(url, headers=headers, json=payload, timeout=args.timeout)
+        response.raise_for_status()
+        return response.json()["data"][0]["embedding"]
 
-    print(f"Request {i+1}: Total={total_latency_ms:.2f} ms | "
-          f"Service={service_time_ms:.2f if service_time_ms else -1} ms")
+    requests_by_query = {}
+    for query in args.queries:
+        if args.scenario == "keyword":
+            request = search_request(target, {"search": query, "top": args.top})
+        elif args.scenario == "vector":
+            request = search_request(target, {"vectorQueries": [vector_query(embed(query))], "top": args.top})
+        elif args.scenario == "hybrid":
+            request = search_request(target, {"search": query, "vectorQueries": [vector_query(embed(query))], "top": args.top})
+        elif args.scenario == "embedding":
+            request = embeddings_request(target, query)
+        else:
+            request = (f"{target['service_url']}/ask", {}, {"question": query, "stream": args.stream})
+        requests_by_query[query] = request
 
-# -----------------------------
-# SUMMARY STATS
-# -----------------------------
-def summarize(name, arr):
-    if len(arr) == 0:
-        return f"{name}: No data"
-    return (
-        f"{name}:\n"
-        f"  Avg:  {statistics.mean(arr):.2f} ms\n"
-        f"  P50:  {statistics.median(arr):.2f} ms\n"
-        f"  P95:  {sorted(arr)[int(len(arr)*0.95)-1]:.2f} ms\n"
-        f"  Min:  {min(arr):.2f} ms\n"
-        f"  Max:  {max(arr):.2f} ms\n"
-    )
-
-print("\n==================== RESULTS ====================\n")
-print(summarize("Total Latency (End-to-End)", total_latencies))
-print(summarize("Service Latency (Azure AI Search)", service_latencies))
-print(summarize("Network Latency (Derived)", network_latencies))
-
-print("================================================\n")
\ No newline at end of file
+    def send(query):
+        url, headers, payload = requests_by_query[query]
+        start = time.perf_counter()
+        if args.scenario == "rag" and args.stream:
+            response = session.post(url, headers=headers, json=payload, timeout=args.timeout, stream=True)
+            first_token_ms = None
+            with response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if first_token_ms is None and line and line.startswith("data:") and '"delta"' in line:
+                        first_token_ms = (time.perf_counter() - start) * 1000
+            return response, first_token_ms
+        return session.post(url, headers=headers, json=payload, timeout=args.timeout), None
+
+    return send
+
+# Function to send one request and record its outcome. scheduled is the intended
+# start time in open-loop mode; latency is measured from it.
+def run_one(send, query, results, record, scheduled=None):
+    start = scheduled if scheduled is not None else time.perf_counter()
+    try:
+        response, first_token_ms = send(query)
+    except requests.exceptions.RequestException as e:
+        if record:
+            results.error(type(e).__name__)
+        return
+    total_ms = (time.perf_counter() - start) * 1000
+    if not record:
+        return
+    if response.status_code >= 400:
+        results.error(str(response.status_code))
+        return
+    cached = False
+    if response.headers.get("Content-Type", "").startswith("application/json"):
+        payload = response.json()
+        cached = isinstance(payload, dict) and payload.get("cached") is True
+    results.record(total_ms, service_time(response), first_token_ms, cached)
+
+# Closed loop: `concurrency` workers each send their next request as soon as the
+# previous one returns, until `requests` have been sent or the deadline passes
+def run_closed_loop(args, send, results):
+    counter = iter(range(args.warmup + args.requests))
+    counter_lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def worker():
+        while deadline is None or time.perf_counter() < deadline:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            run_one(send, args.queries[i % len(args.queries)], results, i >= args.warmup)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+# Open loop: requests start at `rate` per second (evenly spaced, or with exponential
+# gaps for --arrival poisson). Arrivals beyond --max-in-flight are counted as dropped.
+def run_open_loop(args, send, results):
+    in_flight = threading.BoundedSemaphore(args.max_in_flight)
+    total = args.warmup + args.requests
+    start = time.perf_counter()
+    deadline = start + args.duration if args.duration else None
+    scheduled = start
+
+    def task(i, scheduled):
+        try:
+            run_one(send, args.queries[i % len(args.queries)], results, i >= args.warmup, scheduled)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=args.max_in_flight) as executor:
+        for i in range(total):
+            scheduled += random.expovariate(args.rate) if args.arrival == "poisson" else 1.0 / args.rate
+            if deadline is not None and scheduled > deadline:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if not in_flight.acquire(blocking=False):
+                if i >= args.warmup:
+                    results.dropped += 1
+                continue
+            executor.submit(task, i, scheduled)
+
+def format_summary(name, summary):
+    if not summary.get("count"):
+        return f"{name}: No data\n"
+    lines = [f"{name}:", f"  Avg:   {summary['mean']:.2f} ms"]
+    for p in PERCENTILES:
+        label = f"P{p:g}:"
+        lines.append(f"  {label:<6} {summary[f'p{p:g}']:.2f} ms")
+    lines.append(f"  Min:   {summary['min']:.2f} ms")
+    lines.append(f"  Max:   {summary['max']:.2f} ms")
+    return "\n".join(lines) + "\n"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark for search, embeddings and RAG")
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=1, help="closed loop: requests kept in flight")
+    parser.add_argument("--rate", type=float, default=10.0, help="open loop: requests started per second")
+    parser.add_argument("--arrival", choices=["constant", "poisson"], default="poisson")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="open loop: arrivals beyond this are dropped")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests (after warmup)")
+    parser.add_argument("--duration", type=float, default=None, help="stop after this many seconds")
+    parser.add_argument("--warmup", type=int, default=10, help="requests sent first and not measured")
+    parser.add_argument("--query", action="append", dest="queries", help="query text, repeatable")
+    parser.add_argument("--queries-file", help="file with one query per line")
+    parser.add_argument("--k", type=int, default=3, help="nearest neighbours for vector queries")
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--stream", action="store_true", help="rag: stream the answer and record time to first token")
+    parser.add_argument("--service-url", default=os.getenv("QUERY_SERVICE_URL", "http://127.0.0.1:8000"))
+    parser.add_argument("--local", action="store_true", help="target bench_server.py instead of Azure")
+    parser.add_argument("--local-port", type=int, default=8900)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            args.queries = (args.queries or []) + [line.strip() for line in f if line.strip()]
+    args.queries = args.queries or [DEFAULT_QUERY]
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    target = targets(args)
+    pool_size = args.concurrency if args.mode == "closed" else args.max_in_flight
+    session = new_session(pool_size)
+    send = build_scenario(args, target, session)
+    results = Results()
+
+    load = f"concurrency {args.concurrency}" if args.mode == "closed" else f"{args.rate:g} req/s ({args.arrival})"
+    print(f"Running {args.scenario} scenario, {args.mode} loop, {load}: {args.requests} requests after {args.warmup} warmup\n")
+    start = time.perf_counter()
+    if args.mode == "closed":
+        run_closed_loop(args, send, results)
+    else:
+        run_open_loop(args, send, results)
+    elapsed = time.perf_counter() - start
+
+    summaries = {name: histogram.summary() for name, histogram in results.latency.items()}
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "scenario": args.scenario,
+        "mode": args.mode,
+        "concurrency": args.concurrency if args.mode == "closed" else None,
+        "rate": args.rate if args.mode == "open" else None,
+        "arrival": args.arrival if args.mode == "open" else None,
+        "local": args.local,
+        "elapsed_s": elapsed,
+        "succeeded": results.succeeded,
+        "errors": results.errors,
+        "dropped": results.dropped,
+        "cached": results.cached,
+        "throughput_rps": results.succeeded / elapsed if elapsed else None,
+        "latency_ms": summaries
+    }
+
+    print("\n==================== RESULTS ====================\n")
+    print(format_summary("Total Latency (End-to-End)", summaries["total"]))
+    print(format_summary("Service Latency (elapsed-time header)", summaries["service"]))
+    print(format_summary("Network Latency (Derived)", summaries["network"]))
+    if args.stream:
+        print(format_summary("Time to First Token", summaries["first_token"]))
+    errors = f"{sum(results.errors.values())}" + (f" {results.errors}" if results.errors else "")
+    print(f"Succeeded: {results.succeeded} | Errors: {errors} | "
+          f"Dropped: {results.dropped} | Throughput: {report['throughput_rps']:.2f} req/s")
+    print("\n================================================\n")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return report
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,9 +1,25 @@
+import argparse
+import hashlib
+import json
 import logging
 import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote, urlparse
 import requests
 from bs4 import BeautifulSoup
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from azure.storage.blob import ContentSettings
 from dotenv import load_dotenv
+from clients import HTTP_TIMEOUT, get_container_client, get_session
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
 
 load_dotenv()
 
@@ -11,49 +27,168 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 required_vars = [
-    "AZURE_OPENAI_ENDPOINT",
-    "AZURE_OPENAI_KEY",
-    "AZURE_AISEARCH_ENDPOINT",
-    "AZURE_AISEARCH_KEY",
-    "AZURE_AISEARCH_INDEX",
-    "MODEL_CHAT_DEPLOYMENT_NAME",
-    "MODEL_EMBEDDINGS_DEPLOYMENT_NAME",
-    "AZURE_STORAGE_ACCOUNT",
-    "AZURE_STORAGE_ACCOUNT_KEY",
-    "AZURE_STORAGE_CONTAINER",
-    "PUBLIC_URL",
-    "BLOB_NAME",
-    "SYSTEM_MESSAGE"
+    "AZURE_STORAGE_CONTAINER"
 ]
- 
+
 for var in required_vars:
     if not os.getenv(var):
         logger.error(f"Missing required environment variable: {var}")
         raise ValueError(f"Missing required environment variable: {var}")
+if not os.getenv("AZURE_STORAGE_CONNECTION_STRING") and not (os.getenv("AZURE_STORAGE_ACCOUNT") and os.getenv("AZURE_STORAGE_ACCOUNT_KEY")):
+    logger.error("Missing AZURE_STORAGE_CONNECTION_STRING or AZURE_STORAGE_ACCOUNT and AZURE_STORAGE_ACCOUNT_KEY")
+    raise ValueError("Missing AZURE_STORAGE_CONNECTION_STRING or AZURE_STORAGE_ACCOUNT and AZURE_STORAGE_ACCOUNT_KEY")
+
+# Pages fetched and uploaded at the same time
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+# ETag / Last-Modified and content hash of every page, for conditional GETs on the next run
+CRAWL_STATE_PATH = os.getenv("CRAWL_STATE_PATH", ".cache/crawl_state.json")
+# Only for sites with a broken certificate chain; turning it off allows spoofed pages
+CRAWL_VERIFY_TLS = os.getenv("CRAWL_VERIFY_TLS", "true").lower() == "true"
+# Blobs larger than BLOB_SINGLE_PUT_BYTES (clients.py) are uploaded as staged blocks,
+# UPLOAD_BLOB_CONCURRENCY blocks at a time
+UPLOAD_BLOB_CONCURRENCY = int(os.getenv("UPLOAD_BLOB_CONCURRENCY", "4"))
+SITEMAP_NAMESPACE = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+
+if not CRAWL_VERIFY_TLS:
+    logger.warning("CRAWL_VERIFY_TLS=false: crawled pages are fetched without verifying TLS certificates")
+    requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+# Function to list the page URLs of a sitemap, following sitemap indexes
+def sitemap_urls(sitemap_url):
+    response = get_session("crawl").get(sitemap_url, timeout=HTTP_TIMEOUT, verify=CRAWL_VERIFY_TLS)
+    response.raise_for_status()
+    root = ET.fromstring(response.content)
+    locations = [loc.text.strip() for loc in root.iter(f"{SITEMAP_NAMESPACE}loc") if loc.text]
+    if root.tag == f"{SITEMAP_NAMESPACE}sitemapindex":
+        return [url for location in locations for url in sitemap_urls(location)]
+    return locations
+
+# Blob name for a page: host and path, e.g. www.example.com/policies/leave.txt
+def blob_name_for(url):
+    parsed = urlparse(url)
+    path = parsed.path.strip("/") or "index"
+    name = re.sub(r"[^A-Za-z0-9._/-]+", "_", f"{parsed.netloc}/{path}")
+    if parsed.query:
+        name += "_" + hashlib.sha256(parsed.query.encode("utf-8")).hexdigest()[:12]
+    return name + ".txt"
+
+def extract_text(html):
+    soup = BeautifulSoup(html, HTML_PARSER)
+    body = soup.body or soup
+    return body.get_text(separator='\n', strip=True)
+
+class CrawlState:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.pages = json.load(f)
+        except FileNotFoundError:
+            self.pages = {}
+
+    def get(self, url):
+        with self._lock:
+            return dict(self.pages.get(url, {}))
+
+    def put(self, url, entry):
+        with self._lock:
+            self.pages[url] = entry
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.pages, f)
+        os.replace(self.path + ".tmp", self.path)
 
-# Step 1: Send a GET request to the URL
-url = f"{os.getenv("PUBLIC_URL")}"
-response = requests.get(url, verify=False)
-response.raise_for_status()  # Ensure we notice bad responses
+# Function to fetch one page with a conditional GET and upload its text unless it is
+# unchanged. Returns "not_modified", "unchanged" or "uploaded".
+def crawl_page(url, blob_name, container_client, state):
+    known = state.get(url)
+    headers = {}
+    if known.get("etag"):
+        headers["If-None-Match"] = known["etag"]
+    if known.get("last_modified"):
+        headers["If-Modified-Since"] = known["last_modified"]
+    response = get_session("crawl").get(url, headers=headers, timeout=HTTP_TIMEOUT, verify=CRAWL_VERIFY_TLS)
+    if response.status_code == 304:
+        return "not_modified"
+    response.raise_for_status()
 
-# Step 2: Parse the HTML content using BeautifulSoup
-soup = BeautifulSoup(response.content, 'html.parser')
+    content = extract_text(response.content)
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    entry = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_hash": content_hash,
+        "blob_name": blob_name
+    }
+    # Servers without validators still get the upload skipped when the text is the same
+    if known.get("content_hash") == content_hash and known.get("blob_name") == blob_name:
+        state.put(url, entry)
+        return "unchanged"
 
-# Step 3: Extract the desired content
-# Assuming we want to extract all text within the body tag
-content = soup.body.get_text(separator='\n', strip=True)
+    blob_client = container_client.get_blob_client(blob_name)
+    blob_client.upload_blob(
+        content.encode("utf-8"),
+        overwrite=True,
+        max_concurrency=UPLOAD_BLOB_CONCURRENCY,
+        content_settings=ContentSettings(content_type="text/plain; charset=utf-8"),
+        metadata={"source_url": quote(url, safe=":/?&=")}
+    )
+    state.put(url, entry)
+    return "uploaded"
 
-# Step 4: Connect to Azure Storage Account
-# Replace with your actual connection string and container name
-connection_string = f"DefaultEndpointsProtocol=https;AccountName={os.getenv("AZURE_STORAGE_ACCOUNT")};AccountKey={os.getenv("AZURE_STORAGE_ACCOUNT_KEY")};EndpointSuffix=core.windows.net"
-container_name = f"{os.getenv("AZURE_STORAGE_CONTAINER")}"
-blob_name = f"{os.getenv("BLOB_NAME")}"
+# Function to crawl pages concurrently. pages is a list of (url, blob name).
+def crawl(pages, concurrency=CRAWL_CONCURRENCY, state_path=CRAWL_STATE_PATH):
+    container_client = get_container_client()
+    state = CrawlState(state_path)
+    counts = {"uploaded": 0, "unchanged": 0, "not_modified": 0, "failed": 0}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(crawl_page, url, blob_name, container_client, state): url for url, blob_name in pages}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                logger.error(f"Failed to crawl {url}: {e}")
+                counts["failed"] += 1
+                continue
+            counts[outcome] += 1
+            logger.info(f"{url}: {outcome.replace('_', ' ')}")
+    state.save()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Crawled {len(pages)} pages in {elapsed:.1f}s ({len(pages) / elapsed if elapsed else 0:.1f} pages/s): "
+                + ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in counts.items()))
+    return counts
 
-blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-container_client = blob_service_client.get_container_client(container_name)
+def main():
+    parser = argparse.ArgumentParser(description="Crawl public pages and upload their text to Azure Blob Storage")
+    parser.add_argument("urls", nargs="*", help="page URLs (default: PUBLIC_URL, uploaded as BLOB_NAME)")
+    parser.add_argument("--sitemap", action="append", default=[], help="sitemap URL, repeatable")
+    parser.add_argument("--urls-file", help="file with one URL per line")
+    parser.add_argument("--concurrency", type=int, default=CRAWL_CONCURRENCY)
+    args = parser.parse_args()
 
-# Step 5: Upload the extracted content to a blob in the storage account
-blob_client = container_client.get_blob_client(blob_name)
-blob_client.upload_blob(content, overwrite=True)
+    urls = list(args.urls)
+    if args.urls_file:
+        with open(args.urls_file, encoding="utf-8") as f:
+            urls.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    for sitemap in args.sitemap:
+        urls.extend(sitemap_urls(sitemap))
+    if urls:
+        pages = [(url, blob_name_for(url)) for url in dict.fromkeys(urls)]
+    elif os.getenv("PUBLIC_URL") and os.getenv("BLOB_NAME"):
+        pages = [(os.getenv("PUBLIC_URL"), os.getenv("BLOB_NAME"))]
+    else:
+        parser.error("Give page URLs, --urls-file or --sitemap, or set PUBLIC_URL and BLOB_NAME")
+    counts = crawl(pages, args.concurrency)
+    print(f"Content uploaded to container '{os.getenv('AZURE_STORAGE_CONTAINER')}': {counts['uploaded']} uploaded, "
+          f"{counts['unchanged'] + counts['not_modified']} unchanged, {counts['failed']} failed.")
 
-print(f"Content uploaded to blob '{blob_name}' in container '{container_name}' successfully.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()